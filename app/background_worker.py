@@ -0,0 +1,119 @@
+import queue
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+class Job:
+    """Handle of a call running on the background worker"""
+    def __init__(self):
+        self.__cancelled = threading.Event()
+        self.on_stopped = None
+
+    @property
+    def cancelled(self):
+        return self.__cancelled.is_set()
+
+    # the call carries on until its next chunk, on_stopped is called on the Tk thread once it has returned
+    def cancel(self, on_stopped=None):
+        if on_stopped is not None:
+            self.on_stopped = on_stopped
+        self.__cancelled.set()
+
+
+class BackgroundWorker:
+    """Runs blocking chatbot calls off the Tk thread and delivers their results back on it.
+
+    Worker threads only put results on a queue, the Tk loop polls that queue every poll_interval ms
+    and runs the callbacks, so callbacks can touch widgets safely. Results of cancelled jobs are dropped,
+    only their on_stopped callback is run once they have returned.
+    """
+    def __init__(self, root, max_workers=2, poll_interval=30):
+        self.root = root
+        self.poll_interval = poll_interval
+        self.__executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='ui-worker')
+        self.__results = queue.Queue()
+        self.__jobs = set()
+        self.__idle_callbacks = []
+        self.__poll_after = self.root.after(self.poll_interval, self.__poll)
+
+    def submit(self, func, *args, on_result=None, on_error=None):
+        job = Job()
+        self.__jobs.add(job)
+
+        def run():
+            if job.cancelled:
+                self.__results.put((job, None, (), True))
+                return
+            try:
+                self.__results.put((job, on_result, (func(*args),), True))
+            except Exception as e:
+                self.__results.put((job, on_error, (e,), True))
+
+        self.__executor.submit(run)
+        return job
+
+    def stream(self, generator_factory, on_chunk, on_done=None, on_error=None):
+        """Iterate a generator on the worker, on_chunk is called on the Tk thread for every item"""
+        job = Job()
+        self.__jobs.add(job)
+
+        def run():
+            generator = None
+            result = (job, on_done, (), True)
+            try:
+                generator = generator_factory()
+                for chunk in generator:
+                    if job.cancelled:
+                        break
+                    self.__results.put((job, on_chunk, (chunk,), False))
+            except Exception as e:
+                result = (job, on_error, (e,), True)
+            finally:
+                # closing on the thread that iterates it is what stops the underlying HTTP stream
+                if generator is not None:
+                    generator.close()
+                # only once the generator is closed, nothing of the job runs after it is reported finished
+                self.__results.put(result)
+
+        self.__executor.submit(run)
+        return job
+
+    def __poll(self):
+        try:
+            while True:
+                job, callback, args, finished = self.__results.get_nowait()
+                if finished:
+                    self.__jobs.discard(job)
+                if job.cancelled:
+                    callback, args = (job.on_stopped, ()) if finished else (None, ())
+                if callback is None:
+                    continue
+                try:
+                    callback(*args)
+                except Exception as e:
+                    logging.exception(f"Error in background job callback: {e}")
+        except queue.Empty:
+            pass
+        if not self.__jobs and self.__idle_callbacks:
+            callbacks, self.__idle_callbacks = self.__idle_callbacks, []
+            for callback in callbacks:
+                callback()
+            if self.__poll_after is None:
+                return
+        self.__poll_after = self.root.after(self.poll_interval, self.__poll)
+
+    # calls callback on the Tk thread once no job is running, e.g. before closing what the jobs use
+    def when_idle(self, callback):
+        self.__idle_callbacks.append(callback)
+
+    def cancel_all(self):
+        for job in list(self.__jobs):
+            job.cancel()
+
+    def shutdown(self):
+        self.cancel_all()
+        if self.__poll_after is not None:
+            self.root.after_cancel(self.__poll_after)
+            self.__poll_after = None
+        self.__executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,271 @@
+"""Answers a JSONL file of queries with the chatbot, without the UI, and writes the results as JSONL.
+
+Each input line is a JSON object with a "query" (other fields, e.g. an "id" or the expected answer, are
+copied to the result) or just a JSON string. Every query is answered in a fresh session. A result adds
+"line", "response", "route", "elapsed_ms" and, when something failed, "error". The "id" is the line
+number unless the input has one. The route is what answered the query: "static", "learned", "cache",
+"account", "loan" or "branch" through OpenAI, or "general".
+
+Results are written in input order unless --unordered is given, then as soon as they are ready. The
+progress is checkpointed next to the output, so an interrupted run continues with --resume.
+
+Run from the app directory:
+    python batch_cli.py queries.jsonl results.jsonl --workers 8
+    python batch_cli.py queries.jsonl results.jsonl --async --workers 64 --unordered --resume
+"""
+import os
+import json
+import time
+import asyncio
+import logging
+import argparse
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, FIRST_COMPLETED, wait
+from dotenv import load_dotenv
+from startup import load_chatbot
+
+load_dotenv("../app/.env")
+
+
+class Checkpoint:
+    """Where a batch run got to: every line before next_line and the lines in done have been written,
+    and the output is valid up to output_offset bytes. Anything written after the last save is rewritten
+    on resume."""
+    def __init__(self, path, input_path):
+        self.path = path
+        self.input_path = os.path.abspath(input_path)
+        self.next_line = 1
+        self.done = set()
+        self.output_offset = 0
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return False
+        with open(self.path, encoding='utf-8') as f:
+            state = json.load(f)
+        if state["input"] != self.input_path:
+            raise SystemExit(f"{self.path} is the checkpoint of {state['input']}, not of {self.input_path}")
+        self.next_line = state["next_line"]
+        self.done = set(state["done"])
+        self.output_offset = state["output_offset"]
+        return True
+
+    def is_done(self, line):
+        return line < self.next_line or line in self.done
+
+    def mark_done(self, line):
+        self.done.add(line)
+        while self.next_line in self.done:
+            self.done.remove(self.next_line)
+            self.next_line += 1
+
+    def save(self, output_offset):
+        self.output_offset = output_offset
+        state = {"input": self.input_path, "next_line": self.next_line, "done": sorted(self.done), "output_offset": output_offset}
+        # replaced atomically so an interruption never leaves half a checkpoint
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(state, f)
+        os.replace(tmp_path, self.path)
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class BatchRunner:
+    """Runs queries through Chatbot.generate_response on a thread pool, or agenerate_response on an event loop.
+
+    At most window queries are read ahead of the results written, so memory stays flat however large
+    the input is.
+    """
+    def __init__(self, chatbot, workers=4, use_async=False, ordered=True, checkpoint_every=100):
+        self.chatbot = chatbot
+        self.workers = workers
+        self.use_async = use_async
+        self.ordered = ordered
+        self.checkpoint_every = checkpoint_every
+        # threads get a second batch queued so they never wait on the writer, tasks are the concurrency
+        self.window = workers if use_async else workers * 2
+
+        self.answered = 0
+        self.errors = 0
+        self.total_elapsed = 0.0
+
+    @staticmethod
+    def read_queries(path):
+        with open(path, encoding='utf-8') as f:
+            for line_number, line in enumerate(f, start=1):
+                yield line_number, line.strip()
+
+    @staticmethod
+    def parse(line_number, line):
+        try:
+            record = json.loads(line)
+        except ValueError as e:
+            return {"id": line_number}, f"Invalid JSON: {e}"
+        if isinstance(record, str):
+            record = {"query": record}
+        if not isinstance(record, dict):
+            return {"id": line_number}, "Expected a JSON object or string"
+        record.setdefault("id", line_number)
+        if not isinstance(record.get("query"), str) or not record["query"].strip():
+            return record, "'query' must be a non-empty string"
+        return record, None
+
+    @staticmethod
+    def result(record, line_number, response=None, route=None, elapsed=0.0, error=None):
+        result = dict(record, line=line_number, response=response, route=route, elapsed_ms=round(elapsed * 1000, 3))
+        if error is not None:
+            result["error"] = error
+        return result
+
+    # a result that needs no answering, queued like the others so it is written in its place
+    @staticmethod
+    def ready(result):
+        future = Future()
+        future.set_result(result)
+        return future
+
+    def answer(self, line_number, record):
+        session = self.chatbot.new_session()
+        start = time.perf_counter()
+        with self.chatbot.use_session(session):
+            try:
+                response = self.chatbot.generate_response(record["query"])
+            except Exception as e:
+                logging.exception(f"Error while answering line {line_number}: {e}")
+                return self.result(record, line_number, elapsed=time.perf_counter() - start, error=f"{type(e).__name__}: {e}")
+        return self.result(record, line_number, response, session.answered_by, time.perf_counter() - start)
+
+    async def aanswer(self, line_number, record):
+        session = self.chatbot.new_session()
+        start = time.perf_counter()
+        with self.chatbot.use_session(session):
+            try:
+                response = await self.chatbot.agenerate_response(record["query"])
+            except Exception as e:
+                logging.exception(f"Error while answering line {line_number}: {e}")
+                return self.result(record, line_number, elapsed=time.perf_counter() - start, error=f"{type(e).__name__}: {e}")
+        return self.result(record, line_number, response, session.answered_by, time.perf_counter() - start)
+
+    # returns a function that starts answering a query and gives back a concurrent.futures.Future
+    def __start_workers(self, stoppers):
+        if not self.use_async:
+            executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='batch')
+            stoppers.append(lambda: executor.shutdown(wait=False, cancel_futures=True))
+            return lambda line_number, record: executor.submit(self.answer, line_number, record)
+
+        loop = asyncio.new_event_loop()
+        thread = threading.Thread(target=loop.run_forever, name='batch-loop', daemon=True)
+        thread.start()
+        stoppers.append(lambda: loop.call_soon_threadsafe(loop.stop))
+        return lambda line_number, record: asyncio.run_coroutine_threadsafe(self.aanswer(line_number, record), loop)
+
+    def run(self, input_path, output_path, checkpoint):
+        with open(output_path, 'r+b' if checkpoint.output_offset else 'wb') as f:
+            # results written after the last checkpoint are answered again
+            f.truncate(checkpoint.output_offset)
+
+        stoppers = []
+        start = time.perf_counter()
+        with open(output_path, 'a', encoding='utf-8') as output:
+            def write(line_number, result):
+                if result is not None:
+                    output.write(json.dumps(result, ensure_ascii=False) + "\n")
+                    self.answered += 1
+                    if "error" in result:
+                        self.errors += 1
+                    self.total_elapsed += result["elapsed_ms"] / 1000
+                # marked before saving, so the checkpoint offset and done lines cover the same results
+                checkpoint.mark_done(line_number)
+                if result is not None and self.answered % self.checkpoint_every == 0:
+                    save()
+
+            def save():
+                output.flush()
+                checkpoint.save(output.tell())
+                elapsed = time.perf_counter() - start
+                logging.info(f"{self.answered} queries answered in {elapsed:.1f}s, {self.answered / elapsed:.1f}/s, {self.errors} errors")
+
+            try:
+                submit = self.__start_workers(stoppers)
+                pending = deque()
+                for line_number, line in self.read_queries(input_path):
+                    if checkpoint.is_done(line_number):
+                        continue
+                    if not line:
+                        # blank lines have no result but still count as done
+                        pending.append((line_number, self.ready(None)))
+                    else:
+                        record, error = self.parse(line_number, line)
+                        if error is not None:
+                            pending.append((line_number, self.ready(self.result(record, line_number, error=error))))
+                        else:
+                            pending.append((line_number, submit(line_number, record)))
+                    self.__drain(pending, write, self.window)
+                self.__drain(pending, write, 0)
+            finally:
+                save()
+                for stop in stoppers:
+                    stop()
+
+    # writes results until at most limit are pending, in input order or as they finish
+    def __drain(self, pending, write, limit):
+        while len(pending) > limit:
+            if self.ordered:
+                line_number, future = pending.popleft()
+                write(line_number, future.result())
+                continue
+
+            finished, _ = wait([future for _, future in pending], return_when=FIRST_COMPLETED)
+            remaining = [(line_number, future) for line_number, future in pending if future not in finished]
+            for line_number, future in pending:
+                if future in finished:
+                    write(line_number, future.result())
+            pending.clear()
+            pending.extend(remaining)
+
+    def summary(self):
+        return {
+            "answered": self.answered,
+            "errors": self.errors,
+            "mean_ms": self.total_elapsed / self.answered * 1000 if self.answered else 0.0
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('input', help='JSONL file of queries')
+    parser.add_argument('output', help='JSONL file the results are written to')
+    parser.add_argument('--workers', type=int, default=4, help='threads, or concurrent tasks with --async')
+    parser.add_argument('--async', dest='use_async', action='store_true', help='use the async pipeline on one event loop instead of threads')
+    parser.add_argument('--unordered', action='store_true', help='write results as they finish instead of in input order')
+    parser.add_argument('--checkpoint', help='checkpoint file, OUTPUT.checkpoint by default')
+    parser.add_argument('--checkpoint-every', type=int, default=100, help='results written between checkpoints')
+    parser.add_argument('--resume', action='store_true', help='continue from the checkpoint of an interrupted run')
+    parser.add_argument('--log-level', default='INFO', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'])
+    args = parser.parse_args()
+
+    logging.basicConfig(level=args.log_level, format='%(asctime)s %(levelname)s [%(threadName)s] %(message)s')
+    checkpoint = Checkpoint(args.checkpoint or f"{args.output}.checkpoint", args.input)
+    if args.resume and checkpoint.load():
+        logging.info(f"Resuming from line {checkpoint.next_line} of {args.input}")
+
+    chatbot = load_chatbot()
+    runner = BatchRunner(chatbot, args.workers, args.use_async, not args.unordered, args.checkpoint_every)
+    try:
+        runner.run(args.input, args.output, checkpoint)
+    except KeyboardInterrupt:
+        logging.info(f"Interrupted, run again with --resume to continue from line {checkpoint.next_line}")
+        raise SystemExit(130)
+    finally:
+        chatbot.knowledgebase.db.connection_close()
+
+    checkpoint.remove()
+    logging.info(f"Completed: {json.dumps(runner.summary())}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+import time
+import uuid
+from conversation_memory import ConversationMemory
+
+
+class ChatSession:
+    """Conversation state of a single customer"""
+    # rough memory used by the object besides its conversation memory and text
+    BASE_SIZE = 400
+
+    __slots__ = ('session_id', 'memory', 'last_user_query', 'last_chatbot_response', 'last_route', 'answered_by', 'last_access')
+
+    def __init__(self, session_id=None, summarise=None, max_history_tokens=1000):
+        self.session_id = session_id or uuid.uuid4().hex
+        self.memory = ConversationMemory(max_history_tokens, summarise)
+        self.last_user_query = ""
+        self.last_chatbot_response = ""
+        self.last_route = None
+        # what answered the last query: 'static', 'learned', 'cache', an intent route or 'general'
+        self.answered_by = None
+        self.last_access = time.monotonic()
+
+    # the recent turns as OpenAI messages, preceded by a summary of the older ones
+    @property
+    def conversation_history(self):
+        return self.memory.messages()
+
+    def add_conversation(self, message):
+        self.memory.add(message["role"], message["content"])
+
+    def touch(self):
+        self.last_access = time.monotonic()
+
+    # approximate bytes held by the session
+    def size(self):
+        return self.BASE_SIZE + len(self.last_user_query) + len(self.last_chatbot_response) + self.memory.size()
+
+    def to_state(self):
+        return {
+            "last_user_query": self.last_user_query,
+            "last_chatbot_response": self.last_chatbot_response,
+            "last_route": self.last_route,
+            "answered_by": self.answered_by,
+            "memory": self.memory.to_state()
+        }
+
+    def load_state(self, state):
+        self.last_user_query = state["last_user_query"]
+        self.last_chatbot_response = state["last_chatbot_response"]
+        self.last_route = state["last_route"]
+        # absent from sessions spilled before it was recorded
+        self.answered_by = state.get("answered_by")
+        self.memory.load_state(state["memory"])
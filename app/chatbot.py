@@ -1,167 +1,485 @@
 import os
-import re
-import random
-import pickle
+import time
+import asyncio
 import datetime
 import logging
+import contextvars
+from contextlib import contextmanager
+from collections import namedtuple
 import openai
-from openai import OpenAI
-from nltk.corpus import stopwords
-from nltk.tokenize import word_tokenize
+from openai import OpenAI, AsyncOpenAI
+from nltk.corpus import stopwords, wordnet
 from nltk.stem import WordNetLemmatizer
 from knowledgebase import KnowledgeBase
-from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.metrics.pairwise import cosine_similarity
+from chat_session import ChatSession
+from learning_store import LearningStore
+from spell_corrector import SpellCorrector
+from response_cache import ResponseCache
+from text_normaliser import TextNormaliser
+from intent_router import IntentRouter
+from static_index import StaticResponseIndex
+from context_selector import ContextSelector
+from openai_resilience import ResilientOpenAI, OpenAIUnavailableError
+from single_flight import SingleFlight
+from startup import profiler
+from metrics import metrics
+
+
+# how a query will be answered, a ready response or the message, cache key and bank details to send to OpenAI
+ResponsePlan = namedtuple('ResponsePlan', ['response', 'message', 'cache_key', 'context'])
 
 
 class Chatbot: 
+    # route -> (heading for the details appended to the query, response when there are no details)
+    DOMAIN_PROMPTS = {
+        'account': ("Here is the list of available bank accounts:", "Sorry, I couldn't find any account information at the moment."),
+        'loan': ("Here is the list of our available loan types:", "Sorry, I couldn't find any loan information at the moment."),
+        'branch': ("Here is the list of our bank branches:", "Sorry, I couldn't find any branch information at the moment.")
+    }
+    # keywords of every route, in priority order when a query mentions several
+    INTENTS = (
+        ('account', ("account", "accounts", "savings", "checking", "deposit", "fixed deposits", "fix deposits", "fixed")),
+        ('loan', ("loan", "borrow", "mortgage", "finance")),
+        ('branch', ("branch", "branches", "branch code", "branch address", "address"))
+    )
+    # below this the local spelling correction is only a guess and the query goes to OpenAI instead
+    LOCAL_CORRECTION_MIN_CONFIDENCE = 0.6
+    # learned answers are accepted above this similarity, and above the lower one when OpenAI is unavailable
+    SIMILARITY_THRESHOLD = 0.9
+    FALLBACK_SIMILARITY_THRESHOLD = 0.6
+
     def __init__(self):
-        self.knowledgebase = KnowledgeBase()
+        with profiler.measure('knowledge base'):
+            self.knowledgebase = KnowledgeBase()
         
         self.lemmatizer = WordNetLemmatizer()
         self.stop_words = set(stopwords.words('english'))
+        self.normaliser = TextNormaliser(self.stop_words, self.lemmatizer)
+        self.intent_router = IntentRouter(self.INTENTS)
+        self.static_index = StaticResponseIndex(
+            self.knowledgebase.static_knowledgebase,
+            self.knowledgebase.static_aliases,
+            self.preprocess_text
+        )
+        # only the bank details and reference rows relevant to a query are put in its prompt
+        self.context_selector = ContextSelector(self.preprocess_text, max_tokens=int(os.getenv('PROMPT_CONTEXT_TOKENS', 300)))
         
         self.model_path = 'chatbot_ml_model.pkl'
         self.vectorizer_path = 'vectorizer.pkl'
-        self.initialize_ml_component()
+        self.learning_log_path = 'learned_pairs.jsonl'
+        self.ann_index_path = 'ann_index.pkl'
+        # 'exact' scans every learned question, 'lsh' is approximate and meant for very large models
+        self.learned_index_type = os.getenv('LEARNED_INDEX_TYPE', 'exact')
+        # recall and latency of the 'lsh' index, see LSHIndex
+        self.learned_index_params = {
+            'n_tables': int(os.getenv('LSH_N_TABLES', 8)),
+            'n_bits': int(os.getenv('LSH_N_BITS', 12)),
+            'probe_neighbours': os.getenv('LSH_PROBE_NEIGHBOURS', 'true').lower() == 'true',
+            'max_candidates': int(os.getenv('LSH_MAX_CANDIDATES', 2000))
+        } if self.learned_index_type == 'lsh' else {}
+        with profiler.measure('learned model'):
+            self.initialize_ml_component()
+        with profiler.measure('spell corrector'):
+            self.initialize_spell_corrector()
         
-        # these are for UI
-        self.last_user_query = ""
-        self.last_chatbot_response = ""
+        # answers from OpenAI to prompts without conversation history, keyed on the query and the context it was given
+        self.response_cache = ResponseCache(self.knowledgebase.db)
+        self.response_cache.purge_expired()
+        # identical questions asked at the same moment share one OpenAI call, keyed like the cache, so a
+        # prompt with conversation history has no key and is never shared with another session
+        self.single_flight = SingleFlight()
         
-        # open ai
-        self.client = OpenAI()
-        self.client.api_key = os.getenv('OPENAI_API_KEY')
+        # open ai, retries are left to self.openai which also rate limits and circuit breaks every call
+        with profiler.measure('OpenAI client'):
+            self.client = OpenAI(max_retries=0)
+            self.client.api_key = os.getenv('OPENAI_API_KEY')
+        self.__async_client = None
+        self.openai = ResilientOpenAI(
+            requests_per_minute=int(os.getenv('OPENAI_REQUESTS_PER_MINUTE', 500)),
+            tokens_per_minute=int(os.getenv('OPENAI_TOKENS_PER_MINUTE', 200000)),
+            deadline=float(os.getenv('OPENAI_REQUEST_DEADLINE', 20))
+        )
         
-        # converstation history
-        self.conversation_history = []
+        # converstation state, the UI uses the default session and the server switches sessions per request
+        self.history_token_budget = int(os.getenv('HISTORY_TOKEN_BUDGET', 1000))
+        self.default_session = self.new_session()
+        self.__active_session = contextvars.ContextVar('active_session', default=None)
     
+    def new_session(self, session_id=None):
+        return ChatSession(session_id, summarise=self.summarise_conversation, max_history_tokens=self.history_token_budget)
+
+    @property
+    def session(self):
+        return self.__active_session.get() or self.default_session
+
+    @contextmanager
+    def use_session(self, session):
+        token = self.__active_session.set(session)
+        try:
+            yield session
+        finally:
+            self.__active_session.reset(token)
+
+    # WordNet and the punkt tokenizer load on first use, doing it here keeps that off the first query
+    def prewarm(self):
+        self.preprocess_text("Warming up the banking assistant")
+
+    @property
+    def conversation_history(self):
+        return self.session.conversation_history
+
+    # these are for UI
+    @property
+    def last_user_query(self):
+        return self.session.last_user_query
+
+    @last_user_query.setter
+    def last_user_query(self, value):
+        self.session.last_user_query = value
+
+    @property
+    def last_chatbot_response(self):
+        return self.session.last_chatbot_response
+
+    @last_chatbot_response.setter
+    def last_chatbot_response(self, value):
+        self.session.last_chatbot_response = value
+
     def add_conversation(self, message):
-        self.conversation_history.append(message)
-        if len(self.conversation_history) == 12:
-            del self.conversation_history[:6]
+        self.session.add_conversation(message)
     
-    def get_response_from_openai(self, message):
-        try:
-            completion = self.client.chat.completions.create(
+    def build_openai_messages(self, message, context=None):
+        if context is None:
+            context = self.knowledgebase.banking_details
+        messages = [
+            {"role": "system", "content": "You are a banking assistant and you only respond using the detail provided. If the query is unrelated to bank, say 'Sorry, I can only answer bank related questions'."},
+            {"role": "system", "content": f"Here are some of the details about the bank:\n {context}"},
+            *self.conversation_history,
+            {"role": "user", "content": f"{message}"}
+        ]
+        self.context_selector.record_prompt(messages)
+        return messages
+
+    # folds turns dropped from a conversation's memory into its running summary, runs off the request path
+    def summarise_conversation(self, summary, turns):
+        messages = [{"role": "system", "content": "Summarise the conversation between a bank customer and the banking assistant in at most three sentences. Keep the facts and questions the assistant may need later."}]
+        if summary:
+            messages.append({"role": "system", "content": f"Summary of the conversation so far: {summary}"})
+        messages.append({"role": "user", "content": "\n".join(f"{role}: {content}" for role, content in turns)})
+
+        with metrics.timer('chatbot_openai_seconds', call='summary'):
+            completion = self.openai.call(
+                self.client.chat.completions.create,
                 model="gpt-3.5-turbo",
-                messages=[
-                    {"role": "system", "content": "You are a banking assistant and you only respond using the detail provided. If the query is unrelated to bank, say 'Sorry, I can only answer bank related questions'."},
-                    {"role": "system", "content": f"Here are some of the details about the bank:\n {self.knowledgebase.banking_details}"},
-                    *self.conversation_history,
-                    {"role": "user", "content": f"{message}"}
-                ]    
+                messages=messages,
+                max_tokens=150
             )
-            self.add_conversation({"role": "user", "content": f"{message}"})
-            response = completion.choices[0].message.content.strip()
-            self.add_conversation({"role": "assistant", "content": f"{response}"})
-            return response
+        return completion.choices[0].message.content.strip()
+
+    def build_typo_fix_messages(self, query):
+        return [
+            {"role": "system", "content": "If there are any typoes and grammer errors in the query fix them, but don't change the query, and just send the query no additional words. If a single word is sent, just fixed typos if there is any, and return the word only"},
+            {"role": "user", "content": f"{query}"}
+        ]
+
+    # maps a failed OpenAI call to the message shown to the user
+    def openai_error_response(self, error):
+        metrics.inc('chatbot_errors_total', metric='openai', error=type(error).__name__)
+        if isinstance(error, OpenAIUnavailableError):
+            logging.warning(f"OpenAI unavailable: {error}")
+            return "Sorry, the response engine is busy at the moment. Please try again in a minute."
 
-        except openai.APIConnectionError as e:
-            logging.error(f"Connection error: {e}")
+        if isinstance(error, openai.APIConnectionError):
+            logging.error(f"Connection error: {error}")
             return "Sorry, I'm having trouble connecting to the response engine. Please try again later."
 
-        except openai.RateLimitError as e:
-            logging.warning(f"Rate limit hit: {e}")
+        if isinstance(error, openai.RateLimitError):
+            logging.warning(f"Rate limit hit: {error}")
             return "Sorry, I'm receiving too many requests at the moment. Please try again in a few seconds."
 
-        except openai.AuthenticationError as e:
-            logging.critical(f"Authentication failed: {e}")
+        if isinstance(error, openai.AuthenticationError):
+            logging.critical(f"Authentication failed: {error}")
             return "Authentication with the AI service failed. Please contact support."
 
-        except openai.OpenAIError as e:
-            logging.error(f"OpenAI error: {e}")
-            print(self.conversation_history)
+        if isinstance(error, openai.OpenAIError):
+            logging.error(f"OpenAI error: {error}")
             return "Sorry, something went wrong while processing your request."
 
+        logging.exception(f"Unexpected error: {error}")
+        return "An unexpected error occurred. Please try again later."
+
+    # None when the prompt carries the conversation history, an answer shaped by one customer's
+    # conversation must never be served to another
+    def response_cache_key(self, query, context, details=None):
+        if self.conversation_history:
+            return None
+        context_fingerprint = self.response_cache.fingerprint(context, details)
+        return self.response_cache.make_key(self.preprocess_text(query), context_fingerprint)
+
+    def get_cached_response(self, message, cache_key, allow_stale=False):
+        if cache_key is None:
+            return None
+        response = self.response_cache.get(cache_key, allow_stale=allow_stale)
+        if response is not None:
+            self.record_cached_response(message, response)
+        return response
+
+    # same as get_cached_response, without blocking the event loop on SQLite
+    async def aget_cached_response(self, message, cache_key, allow_stale=False):
+        if cache_key is None:
+            return None
+        response = await self.response_cache.aget(cache_key, allow_stale=allow_stale)
+        if response is not None:
+            self.record_cached_response(message, response)
+        return response
+
+    def record_cached_response(self, message, response):
+        self.session.answered_by = 'cache'
+        self.add_conversation({"role": "user", "content": f"{message}"})
+        self.add_conversation({"role": "assistant", "content": f"{response}"})
+
+    # when OpenAI is down or throttling past the deadline, answers from an expired cache entry or a
+    # looser match in the learned model before falling back to an apology
+    def fallback_response(self, message, cache_key, error):
+        if not isinstance(error, (OpenAIUnavailableError,) + ResilientOpenAI.TRANSIENT_ERRORS):
+            return self.openai_error_response(error)
+
+        response = self.get_cached_response(message, cache_key, allow_stale=True)
+        if response is not None:
+            metrics.inc('chatbot_openai_fallback_total', source='stale_cache')
+            return response
+
+        # domain messages carry their details after a blank line, the query comes first
+        query = message.partition("\n\n")[0]
+        similar_question = self.find_similar_question_from_model(query, self.FALLBACK_SIMILARITY_THRESHOLD)
+        if similar_question:
+            metrics.inc('chatbot_openai_fallback_total', source='learned_model')
+            return self.respond_from_model(query, similar_question)
+
+        metrics.inc('chatbot_openai_fallback_total', source='none')
+        return self.openai_error_response(error)
+
+    # callers sharing an in-flight answer each add it to the history of their own session
+    def get_response_from_openai(self, message, cache_key=None, context=None):
+        cached_response = self.get_cached_response(message, cache_key)
+        if cached_response is not None:
+            return cached_response
+
+        try:
+            response = self.single_flight.do(cache_key, self.complete_with_openai, message, cache_key, context)
         except Exception as e:
-            logging.exception(f"Unexpected error: {e}")
-            return "An unexpected error occurred. Please try again later."
+            return self.fallback_response(message, cache_key, e)
+
+        self.add_conversation({"role": "user", "content": f"{message}"})
+        self.add_conversation({"role": "assistant", "content": f"{response}"})
+        return response
+
+    # the prompt carries the history of the session that makes the call, like the cached answers do
+    def complete_with_openai(self, message, cache_key=None, context=None):
+        with metrics.timer('chatbot_openai_seconds', call='chat'):
+            completion = self.openai.call(
+                self.client.chat.completions.create,
+                model="gpt-3.5-turbo",
+                messages=self.build_openai_messages(message, context)
+            )
+        response = completion.choices[0].message.content.strip()
+        if cache_key is not None:
+            self.response_cache.put(cache_key, response)
+        return response
         
-    def fix_typos_and_grammer(self, query):
+    # the conversation history and the cache are only updated once the whole answer has arrived,
+    # closing the generator early drops the answer and closes the HTTP stream
+    def get_response_from_openai_stream(self, message, cache_key=None, context=None):
+        cached_response = self.get_cached_response(message, cache_key)
+        if cached_response is not None:
+            yield cached_response
+            return
+
+        chunks = []
         try:
-            print(f"Query -> {query}")
-            completion = self.client.chat.completions.create(
+            start = time.perf_counter()
+            stream = self.openai.call(
+                self.client.chat.completions.create,
                 model="gpt-3.5-turbo",
-                messages=[
-                    {"role": "system", "content": "If there are any typoes and grammer errors in the query fix them, but don't change the query, and just send the query no additional words. If a single word is sent, just fixed typos if there is any, and return the word only"},
-                    {"role": "user", "content": f"{query}"}
-                ]    
+                messages=self.build_openai_messages(message, context),
+                stream=True
             )
+            try:
+                for chunk in stream:
+                    content = chunk.choices[0].delta.content if chunk.choices else None
+                    if content:
+                        if not chunks:
+                            metrics.observe('chatbot_openai_first_token_seconds', time.perf_counter() - start)
+                        chunks.append(content)
+                        yield content
+            finally:
+                stream.close()
+            metrics.observe('chatbot_openai_seconds', time.perf_counter() - start, call='chat_stream')
+
+        except Exception as e:
+            # keep what was already shown rather than replacing it with an error
+            if chunks:
+                self.openai_error_response(e)
+            else:
+                yield self.fallback_response(message, cache_key, e)
+            return
+
+        response = "".join(chunks).strip()
+        self.add_conversation({"role": "user", "content": f"{message}"})
+        self.add_conversation({"role": "assistant", "content": f"{response}"})
+        if cache_key is not None:
+            self.response_cache.put(cache_key, response)
+
+    def fix_typos_and_grammer(self, query):
+        logging.debug(f"Query -> {query}")
+        with metrics.timer('chatbot_stage_seconds', stage='typo_fix'):
+            corrected_query, confidence = self.spell_corrector.correct(query)
+            if confidence >= self.LOCAL_CORRECTION_MIN_CONFIDENCE:
+                metrics.inc('chatbot_typo_fix_total', corrector='local')
+                return corrected_query
+            metrics.inc('chatbot_typo_fix_total', corrector='openai')
+            return self.fix_typos_and_grammer_with_openai(query)
+
+    def fix_typos_and_grammer_with_openai(self, query):
+        try:
+            with metrics.timer('chatbot_openai_seconds', call='typo_fix'):
+                completion = self.openai.call(
+                    self.client.chat.completions.create,
+                    model="gpt-3.5-turbo",
+                    messages=self.build_typo_fix_messages(query)
+                )
             return completion.choices[0].message.content.strip()
 
-        except openai.APIConnectionError as e:
-            logging.error(f"Connection error: {e}")
-            return "Sorry, I'm having trouble connecting to the response engine. Please try again later."
+        except Exception as e:
+            # never let an error message stand in for the query
+            logging.warning(f"Typo fix failed, using the query as typed: {e}")
+            return query
 
-        except openai.RateLimitError as e:
-            logging.warning(f"Rate limit hit: {e}")
-            return "Sorry, I'm receiving too many requests at the moment. Please try again in a few seconds."
+    # the async client is created on first use so it binds to the event loop that uses it
+    @property
+    def async_client(self):
+        if self.__async_client is None:
+            self.__async_client = AsyncOpenAI(api_key=os.getenv('OPENAI_API_KEY'), max_retries=0)
+        return self.__async_client
 
-        except openai.AuthenticationError as e:
-            logging.critical(f"Authentication failed: {e}")
-            return "Authentication with the AI service failed. Please contact support."
+    async def aget_response_from_openai(self, message, cache_key=None, context=None):
+        cached_response = await self.aget_cached_response(message, cache_key)
+        if cached_response is not None:
+            return cached_response
 
-        except openai.OpenAIError as e:
-            logging.error(f"OpenAI error: {e}")
-            return "Sorry, something went wrong while processing your request."
+        try:
+            response = await self.single_flight.ado(cache_key, self.acomplete_with_openai, message, cache_key, context)
+        except Exception as e:
+            # reads the stale cache and searches the learned model, the session goes along with the context
+            return await asyncio.to_thread(self.fallback_response, message, cache_key, e)
+
+        self.add_conversation({"role": "user", "content": f"{message}"})
+        self.add_conversation({"role": "assistant", "content": f"{response}"})
+        return response
+
+    async def acomplete_with_openai(self, message, cache_key=None, context=None):
+        with metrics.timer('chatbot_openai_seconds', call='chat_async'):
+            completion = await self.openai.acall(
+                self.async_client.chat.completions.create,
+                model="gpt-3.5-turbo",
+                messages=self.build_openai_messages(message, context)
+            )
+        response = completion.choices[0].message.content.strip()
+        if cache_key is not None:
+            await self.response_cache.aput(cache_key, response)
+        return response
+
+    async def afix_typos_and_grammer(self, query):
+        with metrics.timer('chatbot_stage_seconds', stage='typo_fix'):
+            return await self.__afix_typos_and_grammer(query)
+
+    async def __afix_typos_and_grammer(self, query):
+        corrected_query, confidence = self.spell_corrector.correct(query)
+        if confidence >= self.LOCAL_CORRECTION_MIN_CONFIDENCE:
+            metrics.inc('chatbot_typo_fix_total', corrector='local')
+            return corrected_query
+
+        metrics.inc('chatbot_typo_fix_total', corrector='openai')
+        try:
+            with metrics.timer('chatbot_openai_seconds', call='typo_fix_async'):
+                completion = await self.openai.acall(
+                    self.async_client.chat.completions.create,
+                    model="gpt-3.5-turbo",
+                    messages=self.build_typo_fix_messages(query)
+                )
+            return completion.choices[0].message.content.strip()
 
         except Exception as e:
-            logging.exception(f"Unexpected error: {e}")
-            return "An unexpected error occurred. Please try again later."
+            logging.warning(f"Typo fix failed, using the query as typed: {e}")
+            return query
         
     def initialize_ml_component(self):
-        print('Initializing ML Model...')
-        # Load model if exists
-        if os.path.exists(self.model_path) and os.path.exists(self.vectorizer_path):
-            with open(self.model_path, 'rb') as f:
-                self.ml_model = pickle.load(f)
-            with open(self.vectorizer_path, 'rb') as f:
-                self.vectorizer = pickle.load(f)
-        else:
-            # Initialize a new model
-            self.vectorizer = TfidfVectorizer()
-            self.ml_model = {}
-                     
-            self.__save_ml_model()
-        print('Completed initializing ML Model')
-        
-    def __save_ml_model(self):
-        print('Saving current ML Model to disk...')
-        with open(self.model_path, 'wb') as f:
-            pickle.dump(self.ml_model, f)
-        with open(self.vectorizer_path, 'wb') as f:
-            pickle.dump(self.vectorizer, f)
-        print('Completed Saving current ML Model to disk')
+        logging.info('Initializing ML Model...')
+        # Load the compacted model and replay anything learned since the last compaction
+        self.learning_store = LearningStore(
+            self.model_path,
+            self.vectorizer_path,
+            self.learning_log_path,
+            index_path=self.ann_index_path,
+            index_type=self.learned_index_type,
+            index_params=self.learned_index_params
+        )
+        self.ml_model = self.learning_store.answers
+        logging.info('Completed initializing ML Model')
+
+    # builds the local spelling dictionary from everything the bank knows about
+    def initialize_spell_corrector(self):
+        logging.info('Initializing spell corrector...')
+        self.spell_corrector = SpellCorrector(word_checker=self.is_dictionary_word)
+        self.spell_corrector.add_words(self.stop_words)
+
+        for pattern, responses in self.knowledgebase.static_knowledgebase.items():
+            self.spell_corrector.add_text(pattern)
+            for response in responses:
+                self.spell_corrector.add_text(response)
+        for alias in self.knowledgebase.static_aliases:
+            self.spell_corrector.add_text(alias)
+        self.spell_corrector.add_text(str(self.knowledgebase.banking_details))
+
+        for rows in self.knowledgebase.get_reference_snapshot().rows.values():
+            for row in rows:
+                self.spell_corrector.add_text(' '.join(str(value) for value in row))
+
+        for known_query in list(self.ml_model.keys()):
+            self.spell_corrector.add_text(known_query)
+        logging.info(f'Completed initializing spell corrector with {len(self.spell_corrector)} words')
+
+    # accepts inflected english words (e.g. "hours", "opening") that are not in the bank vocabulary
+    def is_dictionary_word(self, word):
+        return wordnet.morphy(word) is not None
         
     # returns the string that only contains the words that in base form
     def preprocess_text(self, text):
-        text = text.lower()
-        text = re.sub(r'[^a-zA-Z0-9\s]', '', text) # remove special characters
-        tokens = word_tokenize(text)
-        tokens = [self.lemmatizer.lemmatize(token) for token in tokens if token not in self.stop_words] # Stop words remove
-        return ' '.join(tokens)
+        with metrics.timer('chatbot_stage_seconds', stage='preprocess'):
+            return self.normaliser.normalise(text)
+
+    def preprocess_many(self, texts):
+        return self.normaliser.preprocess_many(texts)
         
-    def find_similar_question_from_model(self, query):
+    # returns the k most similar learned questions as (question, score) pairs, best first
+    def find_top_k(self, query, k=5):
         if not self.ml_model:
-            return None
-        SIMILARITY_THRESHOLD = 0.9
+            return []
         processed_query = self.preprocess_text(query)
-        query_vec = self.vectorizer.transform([processed_query])
-        
-        # Calculate similarities with the questions in the
-        similarities = {}
-        for known_query in self.ml_model:
-            known_vec = self.vectorizer.transform([known_query])
-            sim = cosine_similarity(query_vec, known_vec)[0][0]
-            similarities[known_query] = sim
+        return self.learning_store.search(processed_query, k)
+
+    def find_similar_question_from_model(self, query, threshold=SIMILARITY_THRESHOLD):
+        with metrics.timer('chatbot_stage_seconds', stage='learned_lookup'):
+            matches = self.find_top_k(query, k=1)
         
         # Return most similar question
-        if similarities:
-            best_match = max(similarities.items(), key=lambda x: x[1])
-            if best_match[1] > SIMILARITY_THRESHOLD: 
+        if matches:
+            best_match = matches[0]
+            if best_match[1] > threshold: 
+                metrics.inc('chatbot_learned_lookup_total', result='hit')
                 return best_match[0]
         
+        metrics.inc('chatbot_learned_lookup_total', result='miss')
         return None
     
     def train_model_from_feedback(self, query, response, feedback):
@@ -176,125 +494,203 @@ class Chatbot:
             timestamp=timestamp
         )
         
-        # Update ML model
+        # Update ML model, the pair is searchable right away and compacted in the background
         if feedback > MINIMUM_POSITIVE_FEEDBACK_LEVEL:
-            if processed_query not in self.ml_model:
-                self.ml_model[processed_query] = response
-                all_queries = list(self.ml_model.keys()) + [processed_query]
-                self.vectorizer.fit(all_queries)
-                self.__save_ml_model()
+            if self.learning_store.add(processed_query, response):
+                self.spell_corrector.add_text(processed_query)
     
+    def respond_from_model(self, query, similar_question):
+        self.session.answered_by = 'learned'
+        self.add_conversation({"role": "user", "content": f"{query}"})
+        response_from_model = self.ml_model[similar_question]
+        self.add_conversation({"role": "assistant", "content": f"{response_from_model}"})
+        logging.debug('Simillar question found')
+        return response_from_model
+
+    # returns the domain handler a query is routed to, or None for a general query
+    def get_query_route(self, query):
+        with metrics.timer('chatbot_stage_seconds', stage='route'):
+            route = self.intent_router.route(query)
+        # kept on the session so a follow up can see what the previous query was about
+        self.session.last_route = route
+        return route
+
+    # decides how a query is answered, either straight away or by asking OpenAI
+    def plan_query(self, query):
+        with metrics.timer('chatbot_stage_seconds', stage='plan'):
+            return self.__plan_query(query)
+
+    def __plan_query(self, query):
+        # Check for similar question from model
+        similar_question = self.find_similar_question_from_model(query)
+        if similar_question:
+            return ResponsePlan(self.respond_from_model(query, similar_question), None, None, None)
+
+        route = self.get_query_route(query)
+        if route:
+            return self.plan_domain_query(route, query)
+
+        # Handle general query
+        return self.plan_general_query(query)
+
+    def plan_general_query(self, query):
+        self.session.answered_by = 'general'
+        context = self.context_selector.select_bank_details(self.knowledgebase.banking_details, query)
+        return ResponsePlan(None, query, self.response_cache_key(query, context), context)
+
     def handle_query(self, query):
         try:
-            # Check for similar question from model
-            similar_question = self.find_similar_question_from_model(query)
-            if similar_question:
-                self.add_conversation({"role": "user", "content": f"{query}"})
-                response_from_model = self.ml_model[similar_question]
-                self.add_conversation({"role": "assistant", "content": f"{response_from_model}"})
-                print('Simillar question found')
-                return response_from_model
-
-            # check keywords related to accoutns
-            if any(word in query.lower() for word in ["account", "accounts", "savings", "checking", "deposit", "fixed deposits", "fix deposits", "fixed"]):
-                return self.handle_account_related_query(query)
-            
-            # Check keywords relateed to loadn
-            elif any(word in query.lower() for word in ["loan", "borrow", "mortgage", "finance"]):
-                return self.handle_loan_related_query(query)
-
-            # Check keywords related to branch
-            elif any(word in query.lower() for word in ["branch", "branches", "branch code", "branch address", "address"]):
-                return self.handle_account_related_query(query)
-
-            # Handle general query
-            return self.get_response_from_openai(query)
+            plan = self.plan_query(query)
+            if plan.response is not None:
+                return plan.response
+            return self.get_response_from_openai(plan.message, cache_key=plan.cache_key, context=plan.context)
 
         except Exception as e:
             logging.exception(f"Error while handling banking query: {e}")
             return "Something went wrong while processing your banking question. Please try again later."
 
-    def handle_account_related_query(self, query):       
+    # the formatted rows come prerendered from the reference data snapshot, no SQL on the hot path
+    # the rows of the route relevant to the query, or None when the table is empty
+    def get_domain_details(self, route, query):
+        lines = self.knowledgebase.get_reference_snapshot().lines[route]
+        return self.context_selector.select_lines(route, lines, query)
+
+    # returns the query with the domain details appended, or None when there is nothing to add
+    def build_domain_query(self, route, query, details):
+        if not details:
+            return None
+        heading, _ = self.DOMAIN_PROMPTS[route]
+        return f"{query}\n\n{heading}\n{details}"
+
+    def plan_domain_query(self, route, query):
+        self.session.answered_by = route
         try:
-            accounts = self.knowledgebase.db.get_all_account_types()
-            
-            if not accounts:
-                return "Sorry, I couldn't find any account information at the moment."
-
-            # format account details
-            account_details = "\n".join([
-                f"- {account[0]}: {account[1]} (Min balance: ${account[2]}, Interest rate: {account[3]}%)"
-                for account in accounts
-            ])
-            
-            updated_query = (
-                f"{query}\n\nHere is the list of available bank accounts:\n{account_details}"
-            )
+            details = self.get_domain_details(route, query)
+            updated_query = self.build_domain_query(route, query, details)
+            if updated_query is None:
+                return ResponsePlan(self.DOMAIN_PROMPTS[route][1], None, None, None)
+
             # Use OpenAI to generate a response
-            return self.get_response_from_openai(updated_query)
+            context = self.context_selector.select_bank_details(self.knowledgebase.banking_details, query)
+            return ResponsePlan(None, updated_query, self.response_cache_key(query, context, details), context)
         
         except Exception as e:
-            logging.exception(f"Error while handling account query: {e}")
-            return "An error occurred while processing your account query. Please try again later."
+            logging.exception(f"Error while handling {route} query: {e}")
+            return ResponsePlan(f"An error occurred while processing your {route} query. Please try again later.", None, None, None)
+
+    def handle_domain_query(self, route, query):
+        plan = self.plan_domain_query(route, query)
+        if plan.response is not None:
+            return plan.response
+        return self.get_response_from_openai(plan.message, cache_key=plan.cache_key, context=plan.context)
+
+    def handle_account_related_query(self, query):       
+        return self.handle_domain_query('account', query)
         
     def handle_branch_related_query(self, query):
-        try:
-            branches = self.knowledgebase.db.get_all_branches()
-            
-            if not branches:
-                return "Sorry, I couldn't find any branch information at the moment."
-
-            # Format branch details
-            branch_details = "\n".join([
-                f"- {branch[0]} (Code: {branch[1]}) located at {branch[2]}"
-                for branch in branches
-            ])
-            
-            update_query = (
-                f"{query}\n\nHere is the list of our bank branches:\n{branch_details}"
-            )
-            # Use OpenAI to generate a response
-            return self.get_response_from_openai(update_query)
-        
-        except Exception as e:
-            logging.exception(f"Error while handling branch query: {e}")
-            return "An error occurred while processing your branch query. Please try again later."
-                
+        return self.handle_domain_query('branch', query)
                 
     def handle_loan_related_query(self, query):
-        try:
-            loans = self.knowledgebase.db.get_all_loan_types()
-            
-            if not loans:
-                return "Sorry, I couldn't find any loan information at the moment."
-
-            # Format loan details
-            loan_details = "\n".join([
-                f"- {loan[0]}: {loan[1]} (Interest rate: {loan[2]}%, Max amount: ${loan[3]:,.0f}, Term: {loan[4]}–{loan[5]} years)"
-                for loan in loans
-            ])
-            updated_query = (
-                f"{query}\n\nHere is the list of our available loan types:\n{loan_details}"
-            )
-            # Use OpenAI to generate a response
-            return self.get_response_from_openai(updated_query)
-        
-        except Exception as e:
-            logging.exception(f"Error while handling loan query: {e}")
-            return "An error occurred while processing your loan query. Please try again later."
+        return self.handle_domain_query('loan', query)
+
+    def get_static_response(self, processed_query):
+        # check if the query matches a pattern of the static knowledgebase
+        with metrics.timer('chatbot_stage_seconds', stage='static_lookup'):
+            response = self.static_index.get_response(processed_query)
+        if response is not None:
+            self.session.answered_by = 'static'
+        return response
     
     def generate_response(self, query):
+        self.session.answered_by = None
+        with metrics.timer('chatbot_stage_seconds', stage='generate_response'):
+            return self.__generate_response(query)
+
+    def __generate_response(self, query):
         # Fix grammer
         typo_and_grammer_fixed_query = self.fix_typos_and_grammer(query)
-        print(typo_and_grammer_fixed_query)
+        logging.debug(f"Fixed query -> {typo_and_grammer_fixed_query}")
         
         processed_query = self.preprocess_text(typo_and_grammer_fixed_query)
         
-        # check if the query pattern exists in the static knowledgebase
-        for pattern, responses in self.knowledgebase.static_knowledgebase.items():
-            if processed_query.strip() == pattern.strip():
-                return random.choice(responses)
+        static_response = self.get_static_response(processed_query)
+        if static_response:
+            return static_response
 
         response = self.handle_query(typo_and_grammer_fixed_query)
         
-        return response
\ No newline at end of file
+        return response
+
+    # same pipeline as generate_response, but yields the OpenAI answer in chunks as they arrive
+    # timed until the last chunk has been yielded, or the stream is closed
+    def generate_response_stream(self, query):
+        self.session.answered_by = None
+        with metrics.timer('chatbot_stage_seconds', stage='generate_response_stream'):
+            yield from self.__generate_response_stream(query)
+
+    def __generate_response_stream(self, query):
+        typo_and_grammer_fixed_query = self.fix_typos_and_grammer(query)
+        logging.debug(f"Fixed query -> {typo_and_grammer_fixed_query}")
+
+        static_response = self.get_static_response(self.preprocess_text(typo_and_grammer_fixed_query))
+        if static_response:
+            yield static_response
+            return
+
+        try:
+            plan = self.plan_query(typo_and_grammer_fixed_query)
+        except Exception as e:
+            logging.exception(f"Error while handling banking query: {e}")
+            yield "Something went wrong while processing your banking question. Please try again later."
+            return
+
+        if plan.response is not None:
+            yield plan.response
+            return
+        yield from self.get_response_from_openai_stream(plan.message, cache_key=plan.cache_key, context=plan.context)
+
+    async def agenerate_response(self, query):
+        self.session.answered_by = None
+        with metrics.timer('chatbot_stage_seconds', stage='agenerate_response'):
+            return await self.__agenerate_response(query)
+
+    async def __agenerate_response(self, query):
+        # the typo fix and the learned-answer lookup on the raw query run at once,
+        # the first stage that produces an answer cancels the rest
+        typo_fix = asyncio.create_task(self.afix_typos_and_grammer(query))
+        raw_lookup = asyncio.create_task(asyncio.to_thread(self.find_similar_question_from_model, query))
+        tasks = [typo_fix, raw_lookup]
+
+        try:
+            static_response = self.get_static_response(self.preprocess_text(query))
+            if static_response:
+                return static_response
+
+            similar_question = await raw_lookup
+            if similar_question:
+                return self.respond_from_model(query, similar_question)
+
+            fixed_query = await typo_fix
+            static_response = self.get_static_response(self.preprocess_text(fixed_query))
+            if static_response:
+                return static_response
+
+            if fixed_query != query:
+                similar_question = await asyncio.to_thread(self.find_similar_question_from_model, fixed_query)
+                if similar_question:
+                    return self.respond_from_model(fixed_query, similar_question)
+
+            route = self.get_query_route(fixed_query)
+            plan = self.plan_domain_query(route, fixed_query) if route else self.plan_general_query(fixed_query)
+            if plan.response is not None:
+                return plan.response
+            return await self.aget_response_from_openai(plan.message, cache_key=plan.cache_key, context=plan.context)
+
+        except Exception as e:
+            logging.exception(f"Error while handling banking query: {e}")
+            return "Something went wrong while processing your banking question. Please try again later."
+
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
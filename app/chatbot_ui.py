@@ -1,7 +1,10 @@
+import bisect
 import logging
 import tkinter as tk
+import tkinter.font as tkfont
 from tkinter import messagebox, simpledialog
-from chatbot import Chatbot
+from background_worker import BackgroundWorker
+from startup import profiler, load_chatbot
 
 
 class RoundedButton(tk.Canvas):
@@ -47,9 +50,13 @@ class RoundedButton(tk.Canvas):
                   x1, y1]
         return self.create_polygon(points, smooth=True, outline="", **kwargs)
 
+    # config(state=tk.DISABLED) on a canvas does not stop its bindings, so the click checks it
+    def is_disabled(self):
+        return str(self.cget("state")) == tk.DISABLED
+
     def on_release(self, event):
         self.itemconfig(self.round_rect, fill=self.color)
-        if self.command:
+        if self.command and not self.is_disabled():
             self.command()
 
     def on_hover(self, event):
@@ -60,8 +67,15 @@ class RoundedButton(tk.Canvas):
 
 
 class ChatbotUI:
+    BUBBLE_FONT = ("Segoe UI", 12)
+    # bubbles kept as widgets above and below the viewport
+    OVERSCAN = 10
+    # horizontal inset and vertical gap of every message row on the canvas
+    ROW_X = 10
+    ROW_GAP = 4
+
     def __init__(self, root):
-        print('Chatbot UI Initializing...')
+        logging.info('Chatbot UI Initializing...')
         self.root = root
         self.root.title('Banking Assistant Chatbot')
         self.root.geometry('900x650')
@@ -88,18 +102,37 @@ class ChatbotUI:
             }
         }
 
-        self.chatbot = Chatbot()
+        self.chatbot = None  # built on the worker so the window shows up before the models are loaded
+        self.worker = BackgroundWorker(self.root)
+        self.current_job = None  # response being generated on the worker, if any
+        self.stopping_job = None  # stopped response whose worker has not returned yet, input waits for it
+        self.response_chunks = []
+        # the query of the response in flight, it becomes the last query only with a complete response
+        self.pending_query = None
+        self._typing_after = None
         self.messages = []  # Store message data for re-rendering
+        self.message_heights = []  # Pixel height of every message row, estimated until it is rendered
+        self.message_offsets = [0]  # Top of every message row, plus the total height at the end
+        self.rendered_messages = {}  # index -> (canvas window, frame, label) for bubbles near the viewport
+        self._render_after = None
         self.last_canvas_width = 0  # Track last width to prevent unnecessary redraws
 
+        self.bubble_font = tkfont.Font(root=self.root, font=self.BUBBLE_FONT)
+        self.bubble_linespace = self.bubble_font.metrics("linespace")
+        self._word_widths = {}
+
         self.create_interface()
         self.display_msg("Banking Assistant", "Hello! I'm your banking assistant. How can I help you today?")
         self.apply_theme() 
         self.root.protocol("WM_DELETE_WINDOW", self.on_close)
 
+        # input stays disabled until the chatbot is ready
+        self.toggle_input_state(tk.DISABLED)
+        self.worker.submit(load_chatbot, on_result=self.on_chatbot_ready, on_error=self.on_chatbot_failed)
+
         # Bind only once to avoid recursion
         self.root.bind("<Configure>", self.schedule_resize_update)
-        print('Chatbot UI Initializing Completed')
+        logging.info('Chatbot UI Initializing Completed')
 
     def create_interface(self):
         # Grid layout
@@ -110,17 +143,16 @@ class ChatbotUI:
         self.chat_frame = tk.Frame(self.root)
         self.chat_frame.grid(row=0, column=0, sticky="nsew", padx=10, pady=10)
 
-        # Chat display (canvas + frame for message bubbles)
+        # Chat display (canvas with one window item per visible message bubble)
         self.chat_canvas = tk.Canvas(self.chat_frame, bd=0, highlightthickness=0)
         self.chat_canvas.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
 
         self.scrollbar = tk.Scrollbar(self.chat_frame, orient="vertical", command=self.chat_canvas.yview)
         self.scrollbar.pack(side=tk.RIGHT, fill="y")
 
-        self.chat_canvas.configure(yscrollcommand=self.scrollbar.set)
-
-        self.chat_inner_frame = tk.Frame(self.chat_canvas, bg=self.theme_colors["light"]["bg"])
-        self.chat_window = self.chat_canvas.create_window((0, 0), window=self.chat_inner_frame, anchor="nw", width=100)
+        # any change of the view, from the scrollbar or from new messages, re-renders the visible bubbles
+        self.chat_canvas.configure(yscrollcommand=self.on_chat_scrolled)
+        self._update_bubble_widths()
 
         # Input Area
         self.input_frame = tk.Frame(self.root)
@@ -164,6 +196,20 @@ class ChatbotUI:
         )
         self.feedback_button.pack(side=tk.LEFT, padx=5)
 
+        self.stop_button = RoundedButton(
+            self.input_frame,
+            text="Stop",
+            radius=15,
+            btn_width=70,
+            height=35,
+            color="#e74c3c",
+            fg="#ffffff",
+            font=("Segoe UI", 10, "bold"),
+            command=self.cancel_response
+        )
+        self.stop_button.pack(side=tk.LEFT, padx=5)
+        self.root.bind("<Escape>", lambda event: self.cancel_response())
+
         # Theme Toggle Button
         self.theme_button = RoundedButton(
             self.root,
@@ -185,8 +231,6 @@ class ChatbotUI:
         self.root.configure(bg=colors["bg"])
         self.chat_frame.configure(bg=colors["bg"])
         self.chat_canvas.configure(bg=colors["bg"])
-        self.chat_inner_frame.configure(bg=colors["bg"])
-        self.msg_frame.configure(bg=colors["bg"])
 
         self.input_frame.configure(bg=colors["bg"])
         self.user_input_text.configure(
@@ -197,16 +241,13 @@ class ChatbotUI:
             highlightbackground=colors["border"]
         )
 
-        # Reapply theme to existing messages
-        for widget in self.chat_inner_frame.winfo_children():
-            if isinstance(widget, tk.Frame):
-                for label in widget.winfo_children():
-                    if isinstance(label, tk.Label):
-                        sender = label.cget("text").split(":")[0]
-                        if sender == "You":
-                            label.configure(bg=colors["user_msg"], fg=colors["fg"])
-                        else:
-                            label.configure(bg=colors["bot_msg"], fg=colors["fg"])
+        # Reapply theme to existing messages, bubbles created later pick up the theme themselves
+        for index, (_, frame, label) in self.rendered_messages.items():
+            frame.configure(bg=colors["bg"])
+            if self.messages[index][0] == "You":
+                label.configure(bg=colors["user_msg"], fg=colors["fg"])
+            else:
+                label.configure(bg=colors["bot_msg"], fg=colors["fg"])
 
     def toggle_theme(self):
         self.dark_mode = not self.dark_mode
@@ -220,7 +261,28 @@ class ChatbotUI:
 
     def display_msg(self, sender, message):
         self.messages.append((sender, message))
-        self.redraw_messages()
+        self.message_heights.append(self._estimate_height(sender, message))
+        self.message_offsets.append(self.message_offsets[-1] + self.message_heights[-1])
+
+        # only the new bubble is created, and only if it is near the viewport
+        self.update_chat_canvas_scrollregion()
+        self.chat_canvas.yview_moveto(1.0)
+        self.render_visible_messages()
+
+    def update_last_msg(self, message):
+        """Replace the text of the newest bubble in place, used while a response streams in"""
+        index = len(self.messages) - 1
+        sender, _ = self.messages[index]
+        self.messages[index] = (sender, message)
+
+        if index in self.rendered_messages:
+            self.rendered_messages[index][2].configure(text=f"{sender}: {message}")
+            self._measure_rendered_messages([index])
+        else:
+            self.message_heights[index] = self._estimate_height(sender, message)
+            self._recompute_offsets(index)
+            self.update_chat_canvas_scrollregion()
+        self.chat_canvas.yview_moveto(1.0)
 
     def schedule_resize_update(self, event=None):
         """Debounce resize event to prevent recursion"""
@@ -232,77 +294,237 @@ class ChatbotUI:
         current_width = self.chat_canvas.winfo_width()
         if abs(current_width - self.last_canvas_width) > 10:
             self.last_canvas_width = current_width
-            self.redraw_messages()
-
-    def redraw_messages(self):
-        # Clear current messages
-        for widget in self.chat_inner_frame.winfo_children():
-            widget.destroy()
+            self.reflow_messages()
+
+    def reflow_messages(self):
+        """Rewrap the existing bubbles in place after a width change instead of recreating them"""
+        self._update_bubble_widths()
+        for window_id, frame, label in self.rendered_messages.values():
+            label.configure(wraplength=self.wraplength)
+            self.chat_canvas.itemconfig(window_id, width=self.row_width)
+
+        self.message_heights = [self._estimate_height(sender, message) for sender, message in self.messages]
+        self._recompute_offsets()
+        self._measure_rendered_messages(list(self.rendered_messages))
+        self.chat_canvas.yview_moveto(1.0)
+        self.render_visible_messages()
 
-        self.root.update_idletasks()  # Force update to get accurate width
-        canvas_width = self.chat_canvas.winfo_width() - 40  # Account for padding
+    def on_chat_scrolled(self, first, last):
+        self.scrollbar.set(first, last)
+        if self._render_after is None:
+            self._render_after = self.root.after_idle(self.render_visible_messages)
 
-        for sender, message in self.messages:
-            self._create_message_bubble(sender, message, canvas_width)
+    def render_visible_messages(self):
+        """Keep bubble widgets only for the messages in or near the viewport"""
+        self._render_after = None
+        if not self.messages:
+            return
 
-        self.chat_canvas.itemconfig(self.chat_window, width=canvas_width)
-        self.update_chat_canvas_scrollregion()
-        self.chat_canvas.yview_moveto(1.0)
-        
+        top = self.chat_canvas.canvasy(0)
+        bottom = top + self.chat_canvas.winfo_height()
+        first = max(bisect.bisect_right(self.message_offsets, top) - 1 - self.OVERSCAN, 0)
+        last = min(bisect.bisect_left(self.message_offsets, bottom) + self.OVERSCAN, len(self.messages))
+
+        for index in [index for index in self.rendered_messages if not first <= index < last]:
+            window_id, frame, _ = self.rendered_messages.pop(index)
+            self.chat_canvas.delete(window_id)
+            frame.destroy()
+
+        created = [index for index in range(first, last) if index not in self.rendered_messages]
+        for index in created:
+            self._create_message_bubble(index)
+        if created:
+            self._measure_rendered_messages(created)
+
+    def _measure_rendered_messages(self, indexes):
+        """Replace the estimated heights of rendered bubbles with their real ones and move the rest"""
+        if not indexes:
+            return
+        was_at_bottom = self.chat_canvas.yview()[1] >= 0.999
+        self.chat_canvas.update_idletasks()
 
-    def _create_message_bubble(self, sender, message, canvas_width):
-        self.msg_frame = tk.Frame(self.chat_inner_frame, bg=self.chat_inner_frame.cget("bg"))
+        changed_from = None
+        for index in sorted(indexes):
+            height = self.rendered_messages[index][1].winfo_reqheight() + self.ROW_GAP
+            if height != self.message_heights[index]:
+                self.message_heights[index] = height
+                if changed_from is None:
+                    changed_from = index
+
+        if changed_from is not None:
+            self._recompute_offsets(changed_from)
+            for index, (window_id, _, _) in self.rendered_messages.items():
+                if index >= changed_from:
+                    self.chat_canvas.coords(window_id, self.ROW_X, self.message_offsets[index] + self.ROW_GAP // 2)
+            self.update_chat_canvas_scrollregion()
+            if was_at_bottom:
+                self.chat_canvas.yview_moveto(1.0)
+
+    def _recompute_offsets(self, start=0):
+        del self.message_offsets[start + 1:]
+        for height in self.message_heights[start:]:
+            self.message_offsets.append(self.message_offsets[-1] + height)
+
+    def _update_bubble_widths(self):
+        canvas_width = max(self.chat_canvas.winfo_width(), 100)
+        self.row_width = canvas_width - 2 * self.ROW_X
+        self.wraplength = min((canvas_width - 40) * 0.7, 400)  # Limit max width
+
+    def _estimate_height(self, sender, message):
+        """Height of a bubble from font metrics, used until the bubble is actually created"""
+        space = self._word_width(" ")
+        lines = 0
+        for paragraph in f"{sender}: {message}".split("\n"):
+            lines += 1
+            line_width = 0
+            for word in paragraph.split(" "):
+                width = self._word_width(word)
+                if line_width and line_width + space + width > self.wraplength:
+                    lines += 1
+                    line_width = width
+                else:
+                    line_width += (space if line_width else 0) + width
+                # words longer than a line are broken across lines
+                while line_width > self.wraplength:
+                    lines += 1
+                    line_width -= self.wraplength
+        # label pady 8 and pack pady 5 on both sides
+        return lines * self.bubble_linespace + 2 * (8 + 5) + self.ROW_GAP
+
+    def _word_width(self, word):
+        width = self._word_widths.get(word)
+        if width is None:
+            width = self.bubble_font.measure(word)
+            self._word_widths[word] = width
+        return width
+
+    def _create_message_bubble(self, index):
+        sender, message = self.messages[index]
+        colors = self.theme_colors["dark" if self.dark_mode else "light"]
+        msg_frame = tk.Frame(self.chat_canvas, bg=colors["bg"])
 
         align = "e" if sender == "You" else "w"
 
-        bg_color = self.theme_colors["dark" if self.dark_mode else "light"]["user_msg"] if sender == "You" else \
-                   self.theme_colors["dark" if self.dark_mode else "light"]["bot_msg"]
-        fg_color = self.theme_colors["dark" if self.dark_mode else "light"]["fg"]
+        bg_color = colors["user_msg"] if sender == "You" else colors["bot_msg"]
+        fg_color = colors["fg"]
 
         msg_label = tk.Label(
-            self.msg_frame,
+            msg_frame,
             text=f"{sender}: {message}",
-            wraplength=min(canvas_width * 0.7, 400),  # Limit max width
+            wraplength=self.wraplength,
             justify="left",
             bg=bg_color,
             fg=fg_color,
             padx=15,
             pady=8,
-            font=("Segoe UI", 12),
+            font=self.BUBBLE_FONT,
             relief="flat",
             bd=0
         )
         msg_label.pack(anchor=align, side="top", padx=10, pady=5)
 
-        self.msg_frame.pack(anchor=align, fill="x", padx=10, pady=2)
+        window_id = self.chat_canvas.create_window(
+            self.ROW_X,
+            self.message_offsets[index] + self.ROW_GAP // 2,
+            window=msg_frame,
+            anchor="nw",
+            width=self.row_width
+        )
+        self.rendered_messages[index] = (window_id, msg_frame, msg_label)
+
+    def on_chatbot_ready(self, chatbot):
+        self.chatbot = chatbot
+        self.toggle_input_state(tk.NORMAL)
+        self.user_input_text.focus_set()
+        profiler.mark('chatbot ready')
+        if profiler.enabled:
+            print(profiler.report())
+
+    def on_chatbot_failed(self, error):
+        logging.error(f"Error while loading the chatbot: {error}")
+        self.display_msg("Banking Assistant", "Sorry, I couldn't start up. Please check the logs and restart the application.")
 
     def process_user_input(self):
         text = self.user_input_text.get().strip()
         self.user_input_text.delete(0, tk.END)
-        if not text:
+        if not text or self.current_job is not None or self.stopping_job is not None:
             return
 
         # Disable input until response comes
         self.toggle_input_state(tk.DISABLED)
 
         self.display_msg("You", text)
-        
-
-        self.chatbot.last_user_query = text
 
-        # Simulate async behavior with after()
-        self.root.after(100, self.generate_bot_response, text)
+        # The response is generated on a worker thread so the window keeps repainting
+        self.generate_bot_response(text)
 
     def generate_bot_response(self, user_text):
-        try:
-            response = self.chatbot.generate_response(user_text)
-            self.chatbot.last_chatbot_response = response
-            self.display_msg("Banking Assistant", response)
-        finally:
-            # Always re-enable input
+        self.response_chunks = []
+        self.pending_query = user_text
+        self.display_msg("Banking Assistant", "typing")
+        self.current_job = self.worker.stream(
+            lambda: self.chatbot.generate_response_stream(user_text),
+            on_chunk=self.on_response_chunk,
+            on_done=self.on_response_done,
+            on_error=self.on_response_error
+        )
+        self.animate_typing_indicator(0)
+
+    def animate_typing_indicator(self, step):
+        """Cycle the dots of the typing indicator until the first chunk arrives"""
+        self._typing_after = None
+        if self.current_job is None or self.response_chunks:
+            return
+        self.update_last_msg("typing" + "." * (step % 3 + 1))
+        self._typing_after = self.root.after(400, self.animate_typing_indicator, step + 1)
+
+    def on_response_chunk(self, chunk):
+        self.response_chunks.append(chunk)
+        self.update_last_msg("".join(self.response_chunks))
+
+    def on_response_done(self):
+        response = "".join(self.response_chunks).strip()
+        # feedback always rates a query together with its own, complete, response
+        self.chatbot.last_user_query = self.pending_query
+        self.chatbot.last_chatbot_response = response
+        self.update_last_msg(response)
+        self.finish_response()
+
+    def on_response_error(self, error):
+        logging.error(f"Error while generating the response: {error}")
+        self.update_last_msg("An unexpected error occurred. Please try again later.")
+        self.finish_response()
+
+    def cancel_response(self):
+        """Stop the response in flight, the worker drops it and closes the stream at the next chunk"""
+        if self.current_job is None:
+            return
+        # the worker may still be fixing the typos or waiting for OpenAI on the same session,
+        # so the next query waits until it has returned
+        self.stopping_job = self.current_job
+        self.current_job.cancel(on_stopped=self.on_response_stopped)
+        partial_response = "".join(self.response_chunks).strip()
+        self.update_last_msg(f"{partial_response} [stopped]" if partial_response else "Response stopped.")
+        self.finish_response()
+
+    def on_response_stopped(self):
+        self.stopping_job = None
+        self.toggle_input_state(tk.NORMAL)
+
+    def finish_response(self):
+        self.current_job = None
+        self.pending_query = None
+        if self._typing_after is not None:
+            self.root.after_cancel(self._typing_after)
+            self._typing_after = None
+        # re-enable input, unless a stopped response is still running
+        if self.stopping_job is None:
             self.toggle_input_state(tk.NORMAL)
 
     def get_feedback(self):
+        # still loading, or failed to load
+        if self.chatbot is None:
+            return
         if not self.chatbot.last_user_query or not self.chatbot.last_chatbot_response:
             messagebox.showinfo("Feedback", "No previous response to provide feedback on.")
             return
@@ -316,17 +538,29 @@ class ChatbotUI:
         )
 
         if feedback:
-            self.chatbot.train_model_from_feedback(
+            # recording and learning from the feedback happens on the worker
+            self.worker.submit(
+                self.chatbot.train_model_from_feedback,
                 self.chatbot.last_user_query,
                 self.chatbot.last_chatbot_response,
-                feedback
+                feedback,
+                on_error=lambda e: logging.error(f"Error while saving feedback: {e}")
             )
             messagebox.showinfo("Feedback", "Thank you for your feedback!")
 
     def update_chat_canvas_scrollregion(self):
-        self.chat_canvas.update_idletasks()
-        self.chat_canvas.configure(scrollregion=self.chat_canvas.bbox("all"))
+        # the region covers every message, including the ones that are not rendered
+        self.chat_canvas.configure(scrollregion=(0, 0, self.chat_canvas.winfo_width(), self.message_offsets[-1]))
 
     def on_close(self):
-        self.chatbot.knowledgebase.db.connection_close()
+        self.cancel_response()
+        self.worker.cancel_all()
+        # the connections are closed only once no worker thread can be using them
+        self.root.withdraw()
+        self.worker.when_idle(self.close)
+
+    def close(self):
+        self.worker.shutdown()
+        if self.chatbot is not None:
+            self.chatbot.knowledgebase.db.connection_close()
         self.root.destroy()
\ No newline at end of file
@@ -0,0 +1,109 @@
+import re
+import math
+import logging
+import threading
+from collections import Counter
+from metrics import metrics
+
+
+TOKEN_PATTERN = re.compile(r"\w+|[^\w\s]")
+
+metrics.set_buckets('chatbot_prompt_tokens', (50, 100, 200, 400, 800, 1600, 3200))
+
+
+# approximate number of tokens OpenAI counts for the text, about a token per word or punctuation mark
+# and never less than one per 4 characters, close enough to budget prompts without a tokenizer
+def count_tokens(text):
+    return max(len(TOKEN_PATTERN.findall(text)), math.ceil(len(text) / 4))
+
+
+class ContextSelector:
+    """Picks the reference rows and bank details relevant to a query, within a token budget.
+
+    Items are scored on the terms they share with the query, each weighted by how rare it is among the
+    items of the same kind (idf), so "branch" counts for nothing when picking a branch but "galle" does.
+    Items that all fit in max_tokens are all kept, so "which loan has the lowest interest rate" sees every
+    loan. Otherwise they are kept best first, in their original order among equal scores, until the budget
+    is used, and returned in their original order. Only the budget drops an item.
+    """
+    WORD_PATTERN = re.compile(r'[A-Za-z0-9]+')
+
+    def __init__(self, normalise, max_tokens=300):
+        # the same normalisation as the queries, so "deposits" in a query matches "Deposit" in a row
+        self.normalise = normalise
+        self.max_tokens = max_tokens
+
+        self.__indexes = {}  # kind -> (source, texts, terms of every text, idf, tokens of every text)
+        self.__lock = threading.Lock()
+        self.prompts = 0
+        self.prompt_tokens = 0
+        self.max_prompt_tokens = 0
+
+    def terms(self, text):
+        return set(self.normalise(' '.join(self.WORD_PATTERN.findall(text))).split())
+
+    # indexes are rebuilt only when the source changes, e.g. a new reference snapshot
+    def __index(self, kind, source, texts):
+        with self.__lock:
+            index = self.__indexes.get(kind)
+        if index is not None and index[0] is source:
+            return index
+
+        text_terms = [self.terms(text) for text in texts]
+        document_frequency = Counter(term for terms in text_terms for term in terms)
+        idf = {term: math.log(len(texts) / count) for term, count in document_frequency.items()}
+        index = (source, texts, text_terms, idf, [count_tokens(text) for text in texts])
+        with self.__lock:
+            self.__indexes[kind] = index
+        return index
+
+    # positions of the texts to include for the query
+    def select(self, kind, source, texts, query):
+        _, texts, text_terms, idf, text_tokens = self.__index(kind, source, texts)
+        if sum(text_tokens) <= self.max_tokens:
+            return list(range(len(texts)))
+
+        query_terms = self.terms(query)
+        scores = [sum(idf[term] for term in terms & query_terms) for terms in text_terms]
+        ranked = sorted(range(len(texts)), key=lambda i: -scores[i])
+
+        selected = []
+        used_tokens = 0
+        for i in ranked:
+            # a row that does not fit is skipped, a smaller one further down may still fit
+            if selected and used_tokens + text_tokens[i] > self.max_tokens:
+                continue
+            selected.append(i)
+            used_tokens += text_tokens[i]
+        return sorted(selected)
+
+    # the prerendered lines of a route relevant to the query, joined like ReferenceSnapshot.details
+    def select_lines(self, route, lines, query):
+        if not lines:
+            return None
+        return "\n".join(lines[i] for i in self.select(route, lines, lines, query))
+
+    # the bank details relevant to the query, in the same dict format as the whole banking_details
+    def select_bank_details(self, banking_details, query):
+        items = list(banking_details.items())
+        texts = [f"{key} {value}" for key, value in items]
+        return str(dict(items[i] for i in self.select('bank', banking_details, texts, query)))
+
+    def record_prompt(self, messages):
+        tokens = sum(count_tokens(message["content"]) for message in messages)
+        with self.__lock:
+            self.prompts += 1
+            self.prompt_tokens += tokens
+            self.max_prompt_tokens = max(self.max_prompt_tokens, tokens)
+        metrics.observe('chatbot_prompt_tokens', tokens)
+        logging.debug(f"OpenAI prompt of {len(messages)} messages, about {tokens} tokens")
+        return tokens
+
+    def stats(self):
+        with self.__lock:
+            return {
+                "prompts": self.prompts,
+                "prompt_tokens": self.prompt_tokens,
+                "average_prompt_tokens": self.prompt_tokens / self.prompts if self.prompts else 0.0,
+                "max_prompt_tokens": self.max_prompt_tokens
+            }
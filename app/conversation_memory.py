@@ -0,0 +1,139 @@
+import logging
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from context_selector import count_tokens
+
+
+class ConversationMemory:
+    """Recent turns of a conversation kept within a token budget, older turns folded into a summary.
+
+    Turns are stored as (role, content, tokens) tuples. When the turns are over max_tokens the oldest are
+    evicted and summarise(summary, [(role, content), ...]) folds them into the running summary on a
+    background thread, so the request that caused the eviction never waits for it. Until that finishes,
+    and whenever summarise fails, a short local summary of the customer's questions is used instead.
+    """
+    MAX_TURN_TOKENS = 400
+    SUMMARY_MAX_TOKENS = 200
+    # rough memory used by the object and by each stored turn, besides the text itself
+    BASE_SIZE = 600
+    TURN_SIZE = 120
+
+    __slots__ = ('max_tokens', 'summarise', 'turns', 'tokens', 'summary', '__pending', '__summarising', '__lock')
+
+    __executor = None
+    __executor_lock = threading.Lock()
+
+    def __init__(self, max_tokens=1000, summarise=None):
+        self.max_tokens = max_tokens
+        self.summarise = summarise
+
+        self.turns = deque()
+        self.tokens = 0
+        self.summary = ""
+        self.__pending = []  # evicted turns not folded into the summary yet
+        self.__summarising = False
+        self.__lock = threading.Lock()
+
+    @classmethod
+    def __get_executor(cls):
+        # one small pool shared by every conversation
+        with cls.__executor_lock:
+            if cls.__executor is None:
+                cls.__executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='conversation-summary')
+            return cls.__executor
+
+    def __len__(self):
+        return len(self.turns)
+
+    def add(self, role, content):
+        # a single huge turn, e.g. a query with all the reference rows appended, is cut short
+        if count_tokens(content) > self.MAX_TURN_TOKENS:
+            content = content[:self.MAX_TURN_TOKENS * 4] + "..."
+        tokens = count_tokens(content)
+
+        with self.__lock:
+            self.turns.append((role, content, tokens))
+            self.tokens += tokens
+            evicted = False
+            while self.tokens > self.max_tokens and len(self.turns) > 1:
+                role, content, tokens = self.turns.popleft()
+                self.tokens -= tokens
+                self.__pending.append((role, content))
+                evicted = True
+            start_summary = evicted and not self.__summarising
+            if start_summary:
+                self.__summarising = True
+
+        if start_summary:
+            self.__get_executor().submit(self.__update_summary)
+
+    def __update_summary(self):
+        while True:
+            with self.__lock:
+                if not self.__pending:
+                    self.__summarising = False
+                    return
+                summary, turns = self.summary, list(self.__pending)
+
+            if self.summarise is None:
+                summary = self.local_summary(summary, turns)
+            else:
+                try:
+                    summary = self.summarise(summary, turns)
+                except Exception as e:
+                    logging.warning(f"Could not summarise the conversation, using a local summary: {e}")
+                    summary = self.local_summary(summary, turns)
+
+            with self.__lock:
+                self.summary = summary
+                del self.__pending[:len(turns)]
+
+    # the customer's evicted questions after the summary, older parts dropped to stay within SUMMARY_MAX_TOKENS
+    def local_summary(self, summary, turns):
+        questions = [content.split("\n", 1)[0] for role, content in turns if role == "user"]
+
+        def render():
+            asked = f"The customer asked: {'; '.join(questions)}." if questions else ""
+            return " ".join(part for part in (summary, asked) if part)
+
+        text = render()
+        while count_tokens(text) > self.SUMMARY_MAX_TOKENS and (summary or len(questions) > 1):
+            if summary:
+                summary = ""
+            else:
+                questions.pop(0)
+            text = render()
+        return text
+
+    # approximate bytes held by the memory
+    def size(self):
+        with self.__lock:
+            text = len(self.summary) + sum(len(content) for _, content, _ in self.turns) + sum(len(content) for _, content in self.__pending)
+            return self.BASE_SIZE + self.TURN_SIZE * (len(self.turns) + len(self.__pending)) + text
+
+    # JSON serialisable state, turns still waiting for the summariser are folded in locally
+    def to_state(self):
+        with self.__lock:
+            summary = self.local_summary(self.summary, self.__pending) if self.__pending else self.summary
+            return {"summary": summary, "turns": [[role, content] for role, content, _ in self.turns]}
+
+    def load_state(self, state):
+        turns = [(role, content, count_tokens(content)) for role, content in state["turns"]]
+        with self.__lock:
+            self.summary = state["summary"]
+            self.turns = deque(turns)
+            self.tokens = sum(tokens for _, _, tokens in turns)
+            self.__pending = []
+
+    # the memory as OpenAI chat messages, the summary first
+    def messages(self):
+        with self.__lock:
+            summary = self.summary
+            # turns evicted since the last summary are covered locally until the summariser catches up
+            if self.__pending:
+                summary = self.local_summary(summary, self.__pending)
+            messages = [{"role": role, "content": content} for role, content, _ in self.turns]
+        if summary:
+            messages.insert(0, {"role": "system", "content": f"Summary of the earlier conversation: {summary}"})
+        return messages
@@ -1,21 +1,74 @@
 import sqlite3
+import logging
+import threading
+from feedback_writer import FeedbackWriter
+from metrics import metrics
 
 
 class Database:
-    def __init__(self):
+    # applied to every pooled connection
+    PRAGMAS = (
+        "PRAGMA journal_mode=WAL",
+        "PRAGMA synchronous=NORMAL",
+        "PRAGMA mmap_size=268435456",
+        "PRAGMA cache_size=-16000",
+        "PRAGMA temp_store=MEMORY",
+        "PRAGMA busy_timeout=5000"
+    )
+    # size of each connection's prepared statement cache
+    CACHED_STATEMENTS = 128
+    # tables whose changes bump reference_version, i.e. the data of the reference snapshot
+    REFERENCE_TABLES = ('accounts', 'loans', 'branches')
+
+    def __init__(self, db_path='bank_db.sqlite'):
+        self.db_path = db_path
         self.__create_connection()
         self.__create_tables()
         self.__initialize_tables_if_not_initialized()
         
+        # feedback is queued and group-committed so callers never wait for a commit
+        self.feedback_writer = FeedbackWriter(self.insert_feedback_batch)
+        
     def __create_connection(self):
-        print('Initializing the database...')
-        self.__conn = sqlite3.connect('bank_db.sqlite')
-        self.__cursor = self.__conn.cursor()
-        print('Completed initializing the database with bank_db.sqlite')   
+        logging.info('Initializing the database...')
+        # every thread gets its own connection, WAL lets readers carry on while another thread writes
+        self.__local = threading.local()
+        self.__pool = []
+        self.__pool_lock = threading.Lock()
+
+        # polls the reference version from any thread without opening a pooled connection for it
+        self.__monitor = self.__open_connection()
+        self.__monitor_lock = threading.Lock()
+        logging.info(f'Completed initializing the database with {self.db_path}')
+
+    def __open_connection(self):
+        conn = sqlite3.connect(self.db_path, check_same_thread=False, cached_statements=self.CACHED_STATEMENTS)
+        for pragma in self.PRAGMAS:
+            conn.execute(pragma)
+        return conn
+
+    # returns the calling thread's connection, opening it on first use
+    def __connection(self):
+        conn = getattr(self.__local, 'conn', None)
+        if conn is None:
+            conn = self.__open_connection()
+            self.__local.conn = conn
+            with self.__pool_lock:
+                # close the connections of threads that have finished
+                alive = []
+                for thread, pooled_conn in self.__pool:
+                    if thread.is_alive():
+                        alive.append((thread, pooled_conn))
+                    else:
+                        pooled_conn.close()
+                alive.append((threading.current_thread(), conn))
+                self.__pool = alive
+        return conn
     
     def __create_tables(self):
-        print('Creating tables...')
-        self.__cursor.execute('''
+        logging.info('Creating tables...')
+        conn = self.__connection()
+        conn.execute('''
            CREATE TABLE IF NOT EXISTS accounts (
                 id INTEGER PRIMARY KEY,
                 type TEXT,
@@ -25,7 +78,7 @@ class Database:
             )                     
         ''')
         
-        self.__cursor.execute('''
+        conn.execute('''
             CREATE TABLE IF NOT EXISTS loans (
                 id INTEGER PRIMARY KEY,
                 type TEXT,
@@ -37,7 +90,7 @@ class Database:
             )
         ''')
         
-        self.__cursor.execute('''
+        conn.execute('''
             CREATE TABLE IF NOT EXISTS branches (
                 id INTEGER PRIMARY KEY,
                 branch_name VARCHAR(100),
@@ -46,7 +99,7 @@ class Database:
             )
         ''')
         
-        self.__cursor.execute('''
+        conn.execute('''
             CREATE TABLE IF NOT EXISTS user_feedback (
                 id INTEGER PRIMARY KEY,
                 query TEXT,
@@ -56,45 +109,83 @@ class Database:
             )
         ''')
         
-        self.__conn.commit()
-        print('Completed creating tables.')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS llm_response_cache (
+                key TEXT PRIMARY KEY,
+                response TEXT,
+                created_at REAL
+            )
+        ''')
+        
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS chat_sessions (
+                session_id TEXT PRIMARY KEY,
+                state TEXT,
+                updated_at REAL
+            )
+        ''')
+        
+        # bumped by triggers on every change to the reference tables, by this process or any other
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS reference_version (
+                id INTEGER PRIMARY KEY CHECK (id = 1),
+                version INTEGER
+            )
+        ''')
+        conn.execute("INSERT OR IGNORE INTO reference_version (id, version) VALUES (1, 0)")
+        for table in self.REFERENCE_TABLES:
+            for event in ('INSERT', 'UPDATE', 'DELETE'):
+                conn.execute(f'''
+                    CREATE TRIGGER IF NOT EXISTS {table}_{event.lower()}_reference_version
+                    AFTER {event} ON {table}
+                    BEGIN
+                        UPDATE reference_version SET version = version + 1 WHERE id = 1;
+                    END
+                ''')
+        
+        conn.commit()
+        logging.info('Completed creating tables.')
         
     def __initialize_tables_if_not_initialized(self):
-        if not self.__cursor.execute('SELECT COUNT(*) FROM accounts').fetchone()[0]:
+        conn = self.__connection()
+        if not conn.execute('SELECT COUNT(*) FROM accounts').fetchone()[0]:
             self.__populate_accounts_table_with_sample_data()
             
-        if not self.__cursor.execute('SELECT COUNT(*) FROM loans').fetchone()[0]:
+        if not conn.execute('SELECT COUNT(*) FROM loans').fetchone()[0]:
             self.__populate_loans_table_with_sample_data()
             
-        if not self.__cursor.execute('SELECT COUNT(*) FROM branches').fetchone()[0]:
+        if not conn.execute('SELECT COUNT(*) FROM branches').fetchone()[0]:
             self.__populate_branches_table_with_sample_data()
     
     def __populate_accounts_table_with_sample_data(self):
-        print('Populating accounts table with sample data...')
+        logging.info('Populating accounts table with sample data...')
+        conn = self.__connection()
         accounts = [
             ("Savings", "Basic savings account", 500, 1.5),
             ("Checking", "Everyday checking account", 1000, 0.1),
             ("Fixed Deposit", "Term deposit with fixed interest", 10000, 3.5),
             ("Joint", "Account shared between multiple people", 2000, 0.5)
         ]
-        self.__cursor.executemany("INSERT INTO accounts (type, description, min_balance, interest_rate) VALUES (?, ?, ?, ?)", accounts)
-        self.__conn.commit()
-        print('Completed populating accounts table with sample data.')
+        conn.executemany("INSERT INTO accounts (type, description, min_balance, interest_rate) VALUES (?, ?, ?, ?)", accounts)
+        conn.commit()
+        logging.info('Completed populating accounts table with sample data.')
     
     def __populate_loans_table_with_sample_data(self):
-        print('Populating loans table with sample data...')
+        logging.info('Populating loans table with sample data...')
+        conn = self.__connection()
         loans = [
             ("Personal", "Unsecured personal loan", 7.5, 50000, 1, 5),
             ("Home", "Mortgage for property purchase", 4.5, 2000000, 5, 30),
             ("Auto", "Vehicle financing", 5.0, 500000, 1, 7),
             ("Education", "Student loan for education", 6.0, 1000000, 1, 10)
         ]
-        self.__cursor.executemany("INSERT INTO loans (type, description, interest_rate, max_amount, min_term, max_term) VALUES (?, ?, ?, ?, ?, ?)", loans)
-        self.__conn.commit()
-        print('Completed populating loans table with sample data.')
+        conn.executemany("INSERT INTO loans (type, description, interest_rate, max_amount, min_term, max_term) VALUES (?, ?, ?, ?, ?, ?)", loans)
+        conn.commit()
+        logging.info('Completed populating loans table with sample data.')
         
     def __populate_branches_table_with_sample_data(self):
-        print('Populating branches table with sample data...')
+        logging.info('Populating branches table with sample data...')
+        conn = self.__connection()
         branches = [
             ("Colombo Main Branch", 101, "123 Galle Road, Colombo 03"),
             ("Kandy City Branch", 102, "45 Dalada Veediya, Kandy"),
@@ -107,40 +198,93 @@ class Database:
             ("Matara Branch", 109, "89 Beach Road, Matara"),
             ("Batticaloa Branch", 110, "14 Trincomalee Road, Batticaloa")
         ]
-        self.__cursor.executemany("INSERT INTO branches (branch_name, branch_code, address) VALUES (?, ?, ?)", branches)
-        self.__conn.commit()
-        print('Completed populating branches table with sample data.')
+        conn.executemany("INSERT INTO branches (branch_name, branch_code, address) VALUES (?, ?, ?)", branches)
+        conn.commit()
+        logging.info('Completed populating branches table with sample data.')
     
     def add_data_to_feedback_table(self, query, response, feedback, timestamp):
-        self.__cursor.execute(
-            "INSERT INTO user_feedback (query, response, feedback, timestamp) VALUES (?, ?, ?, ?)",
-            (query, response, feedback, timestamp)
-        )
-        
-        self.__conn.commit()
+        self.feedback_writer.submit((query, response, feedback, timestamp))
+
+    @metrics.timed('chatbot_db_seconds', query='insert_feedback_batch')
+    def insert_feedback_batch(self, rows):
+        with self.__connection() as conn:
+            conn.executemany(
+                "INSERT INTO user_feedback (query, response, feedback, timestamp) VALUES (?, ?, ?, ?)",
+                rows
+            )
     
+    @metrics.timed('chatbot_db_seconds', query='get_all_account_types')
     def get_all_account_types(self):
         # Get all account types from database
-        self.__cursor.execute("SELECT type, description, min_balance, interest_rate FROM accounts")
-        accounts = self.__cursor.fetchall()
-        return accounts
+        return self.__connection().execute("SELECT type, description, min_balance, interest_rate FROM accounts").fetchall()
 
+    @metrics.timed('chatbot_db_seconds', query='get_all_loan_types')
     def get_all_loan_types(self):
         # Get all loan types from database
-        self.__cursor.execute("SELECT type, description, interest_rate, max_amount, min_term, max_term FROM loans")
-        loans = self.__cursor.fetchall()
-        return loans
+        return self.__connection().execute("SELECT type, description, interest_rate, max_amount, min_term, max_term FROM loans").fetchall()
     
+    @metrics.timed('chatbot_db_seconds', query='get_all_branches')
     def get_all_branches(self):
-        self.__cursor.execute("SELECT branch_name, branch_code, address FROM branches")
-        branches = self.__cursor.fetchall()
-        return branches    
+        return self.__connection().execute("SELECT branch_name, branch_code, address FROM branches").fetchall()
     
+    @metrics.timed('chatbot_db_seconds', query='get_all_feedbacks')
     def get_all_feedbacks(self):
-        self.__cursor.execute("SELECT query, response, feedback, timestamp FROM user_feedback")
-        user_feedbacks = self.__cursor.fetchall()
-        return user_feedbacks
+        return self.__connection().execute("SELECT query, response, feedback, timestamp FROM user_feedback").fetchall()
+    
+    # changes whenever accounts, loans or branches change, not on writes to the cache, sessions or feedback
+    @metrics.timed('chatbot_db_seconds', query='get_reference_version')
+    def get_reference_version(self):
+        with self.__monitor_lock:
+            return self.__monitor.execute("SELECT version FROM reference_version WHERE id = 1").fetchone()[0]
+    
+    @metrics.timed('chatbot_db_seconds', query='get_cached_response')
+    def get_cached_response(self, key):
+        return self.__connection().execute("SELECT response, created_at FROM llm_response_cache WHERE key = ?", (key,)).fetchone()
+    
+    @metrics.timed('chatbot_db_seconds', query='put_cached_response')
+    def put_cached_response(self, key, response, created_at):
+        with self.__connection() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO llm_response_cache (key, response, created_at) VALUES (?, ?, ?)",
+                (key, response, created_at)
+            )
+    
+    @metrics.timed('chatbot_db_seconds', query='delete_cached_responses_before')
+    def delete_cached_responses_before(self, created_at):
+        with self.__connection() as conn:
+            conn.execute("DELETE FROM llm_response_cache WHERE created_at < ?", (created_at,))
+    
+    # conversations spilled from memory, state is the JSON of the session
+    @metrics.timed('chatbot_db_seconds', query='save_sessions')
+    def save_sessions(self, rows):
+        with self.__connection() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO chat_sessions (session_id, state, updated_at) VALUES (?, ?, ?)",
+                rows
+            )
+    
+    @metrics.timed('chatbot_db_seconds', query='get_session_state')
+    def get_session_state(self, session_id):
+        row = self.__connection().execute("SELECT state FROM chat_sessions WHERE session_id = ?", (session_id,)).fetchone()
+        return row[0] if row else None
+    
+    @metrics.timed('chatbot_db_seconds', query='delete_sessions')
+    def delete_sessions(self, session_ids):
+        with self.__connection() as conn:
+            conn.executemany("DELETE FROM chat_sessions WHERE session_id = ?", [(session_id,) for session_id in session_ids])
+    
+    @metrics.timed('chatbot_db_seconds', query='delete_sessions_before')
+    def delete_sessions_before(self, updated_at):
+        with self.__connection() as conn:
+            conn.execute("DELETE FROM chat_sessions WHERE updated_at < ?", (updated_at,))
     
     def connection_close(self):
-        self.__conn.close()
-        
\ No newline at end of file
+        # write out the queued feedback before the connections go away
+        self.feedback_writer.close()
+        with self.__pool_lock:
+            for _, conn in self.__pool:
+                conn.close()
+            self.__pool = []
+        with self.__monitor_lock:
+            self.__monitor.close()
+        self.__local = threading.local()
@@ -0,0 +1,103 @@
+import time
+import queue
+import logging
+import threading
+
+
+class FeedbackWriter:
+    """Queues user_feedback rows and group-commits them on a background thread.
+
+    A batch is written once it holds max_batch_size rows or its oldest row has waited max_delay seconds,
+    so a burst of feedback costs one transaction instead of one fsync per row.
+    """
+    __STOP = object()
+
+    def __init__(self, write_batch, max_batch_size=100, max_delay=0.5):
+        self.write_batch = write_batch
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+
+        self.__queue = queue.Queue()
+        self.__closed = False
+        self.__close_lock = threading.Lock()
+
+        self.submitted = 0
+        self.written = 0
+        self.failed = 0
+        self.batches = 0
+        self.max_queue_depth = 0
+
+        self.__thread = threading.Thread(target=self.__run, name='feedback-writer', daemon=True)
+        self.__thread.start()
+
+    def submit(self, row):
+        if self.__closed:
+            raise RuntimeError("Feedback writer is closed")
+        self.__queue.put(row)
+        self.submitted += 1
+        self.max_queue_depth = max(self.max_queue_depth, self.__queue.qsize())
+
+    def queue_depth(self):
+        return self.__queue.qsize()
+
+    # blocks until every row submitted so far has been written
+    def flush(self):
+        self.__queue.join()
+
+    def close(self, timeout=10):
+        with self.__close_lock:
+            if self.__closed:
+                return
+            self.__closed = True
+        self.__queue.put(self.__STOP)
+        self.__thread.join(timeout)
+        if self.__thread.is_alive():
+            logging.error(f"Feedback writer did not finish within {timeout}s, {self.queue_depth()} rows not written")
+
+    def __run(self):
+        stopping = False
+        while not stopping:
+            row = self.__queue.get()
+            if row is self.__STOP:
+                self.__queue.task_done()
+                break
+
+            batch = [row]
+            deadline = time.monotonic() + self.max_delay
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    row = self.__queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if row is self.__STOP:
+                    self.__queue.task_done()
+                    stopping = True
+                    break
+                batch.append(row)
+
+            self.__write(batch)
+
+    def __write(self, batch):
+        try:
+            self.write_batch(batch)
+            self.written += len(batch)
+            self.batches += 1
+        except Exception as e:
+            self.failed += len(batch)
+            logging.exception(f"Error while writing {len(batch)} feedback rows: {e}")
+        finally:
+            for _ in batch:
+                self.__queue.task_done()
+
+    def stats(self):
+        return {
+            "queue_depth": self.queue_depth(),
+            "max_queue_depth": self.max_queue_depth,
+            "submitted": self.submitted,
+            "written": self.written,
+            "failed": self.failed,
+            "batches": self.batches
+        }
@@ -0,0 +1,51 @@
+import re
+import threading
+from collections import Counter, namedtuple
+from metrics import metrics
+
+
+IntentMatch = namedtuple('IntentMatch', ['intent', 'keyword', 'start', 'end'])
+
+
+class IntentRouter:
+    """Routes a query to an intent using keywords, in a single pass over the query.
+
+    intents is an ordered sequence of (intent, keywords), earlier intents win when several match.
+    All keywords are compiled into one case-insensitive regex with a named group per intent, wrapped in a
+    lookahead so that a match is found at every position of the query, including overlapping ones.
+    Keywords match anywhere in the query, the same as `keyword in query.lower()`.
+    """
+    def __init__(self, intents):
+        self.intents = tuple((intent, tuple(keywords)) for intent, keywords in intents)
+        self.priority = {intent: i for i, (intent, _) in enumerate(self.intents)}
+
+        groups = []
+        for intent, keywords in self.intents:
+            # longest first, so the keyword reported is the most specific one
+            alternatives = '|'.join(re.escape(keyword.lower()) for keyword in sorted(keywords, key=len, reverse=True))
+            groups.append(f"(?P<{intent}>{alternatives})")
+        self.pattern = re.compile(f"(?=(?:{'|'.join(groups)}))", re.IGNORECASE)
+
+        self.route_counts = Counter()
+        self.__lock = threading.Lock()
+
+    # all keyword matches of the query as IntentMatch, ordered by position
+    def match(self, query):
+        matches = []
+        for found in self.pattern.finditer(query):
+            intent = found.lastgroup
+            matches.append(IntentMatch(intent, found.group(intent), found.start(intent), found.end(intent)))
+        return matches
+
+    # the intent with the highest priority among the matches, or None
+    def route(self, query):
+        matches = self.match(query)
+        intent = min((match.intent for match in matches), key=self.priority.__getitem__, default=None)
+        with self.__lock:
+            self.route_counts[intent or 'none'] += 1
+        metrics.inc('chatbot_route_total', route=intent or 'none')
+        return intent
+
+    def stats(self):
+        with self.__lock:
+            return dict(self.route_counts)
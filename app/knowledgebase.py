@@ -1,9 +1,27 @@
+import time
+import logging
+import threading
+from types import MappingProxyType
+from collections import namedtuple
 from database import Database
 
+
+# immutable copy of the reference tables, with the prompt fragments already rendered
+# rows, lines and details are read-only mappings keyed by route ('account', 'loan', 'branch')
+ReferenceSnapshot = namedtuple('ReferenceSnapshot', ['version', 'rows', 'lines', 'details'])
+
 class KnowledgeBase:
+    # how often, in seconds, a background thread asks SQLite whether the reference data changed
+    SNAPSHOT_CHECK_INTERVAL = 1.0
+
     def __init__(self):
         self.init_database()
         
+        self.__snapshot_lock = threading.Lock()
+        self.__snapshot = self.__load_reference_snapshot(self.db.get_reference_version())
+        self.__snapshot_checked_at = time.monotonic()
+        self.__snapshot_refreshing = False
+        
         self.static_knowledgebase = {
             # Greetings
             "hi": [
@@ -55,6 +73,27 @@ class KnowledgeBase:
             ]
         }
         
+        # other ways of saying the static patterns above, alias -> pattern
+        self.static_aliases = {
+            "hii": "hi",
+            "hiya": "hi",
+            "howdy": "hello",
+            "greetings": "hello",
+            "hey there": "hey",
+            "morning": "good morning",
+            "afternoon": "good afternoon",
+            "evening": "good evening",
+            "thank you": "thanks",
+            "thank you very much": "thanks",
+            "thanks a lot": "thanks",
+            "thx": "thanks",
+            "ty": "thanks",
+            "appreciate it": "thanks",
+            "good bye": "goodbye",
+            "see you later": "bye",
+            "cya": "bye"
+        }
+
         # Banking knowledge base
         self.banking_details = {
             "name": "TrustBank",
@@ -75,4 +114,58 @@ class KnowledgeBase:
         }
 
     def init_database(self):
-         self.db = Database()
\ No newline at end of file
+         self.db = Database()
+
+    # never touches SQLite, a due check runs on a thread of its own and the current snapshot is returned meanwhile
+    def get_reference_snapshot(self):
+        now = time.monotonic()
+        if now - self.__snapshot_checked_at >= self.SNAPSHOT_CHECK_INTERVAL:
+            with self.__snapshot_lock:
+                refresh = not self.__snapshot_refreshing and now - self.__snapshot_checked_at >= self.SNAPSHOT_CHECK_INTERVAL
+                if refresh:
+                    self.__snapshot_refreshing = True
+            if refresh:
+                threading.Thread(target=self.__refresh_reference_snapshot, name='reference-snapshot', daemon=True).start()
+        return self.__snapshot
+
+    def __refresh_reference_snapshot(self):
+        try:
+            version = self.db.get_reference_version()
+            if version != self.__snapshot.version:
+                self.__snapshot = self.__load_reference_snapshot(version)
+        except Exception as e:
+            logging.warning(f"Could not refresh the reference data snapshot: {e}")
+        finally:
+            with self.__snapshot_lock:
+                self.__snapshot_checked_at = time.monotonic()
+                self.__snapshot_refreshing = False
+
+    def __load_reference_snapshot(self, version):
+        logging.info('Loading reference data snapshot...')
+        rows = {
+            'account': tuple(self.db.get_all_account_types()),
+            'loan': tuple(self.db.get_all_loan_types()),
+            'branch': tuple(self.db.get_all_branches())
+        }
+        lines = {
+            'account': tuple(
+                f"- {account[0]}: {account[1]} (Min balance: ${account[2]}, Interest rate: {account[3]}%)"
+                for account in rows['account']
+            ),
+            'loan': tuple(
+                f"- {loan[0]}: {loan[1]} (Interest rate: {loan[2]}%, Max amount: ${loan[3]:,.0f}, Term: {loan[4]}–{loan[5]} years)"
+                for loan in rows['loan']
+            ),
+            'branch': tuple(
+                f"- {branch[0]} (Code: {branch[1]}) located at {branch[2]}"
+                for branch in rows['branch']
+            )
+        }
+        details = {route: "\n".join(route_lines) or None for route, route_lines in lines.items()}
+        logging.info('Completed loading reference data snapshot')
+        return ReferenceSnapshot(
+            version=version,
+            rows=MappingProxyType(rows),
+            lines=MappingProxyType(lines),
+            details=MappingProxyType(details)
+        )
\ No newline at end of file
@@ -0,0 +1,222 @@
+import os
+import json
+import time
+import pickle
+import logging
+import threading
+from scipy.sparse import vstack
+from sklearn.feature_extraction.text import TfidfVectorizer, HashingVectorizer
+from similarity_index import ExactIndex, create_index
+
+
+class LearningStore:
+    """Learned question/answer pairs kept as a compacted TF-IDF segment plus an append-only delta segment.
+
+    New pairs are appended to a log and searchable straight away. An index that can grow ('lsh') gets
+    them with the current TF-IDF vectorizer, and the delta only keeps, as stateless hashing vectors,
+    the ones with words the vectorizer does not know; with the 'exact' index the delta keeps them all.
+    The vectorizer is refitted and the pickles rewritten on a background thread once the delta is
+    COMPACT_RATIO of the model (at least COMPACT_SIZE entries), so a refit is paid for by a number of
+    new pairs proportional to its cost. A model of fewer than COMPACT_SIZE / COMPACT_RATIO entries is
+    also compacted every COMPACT_INTERVAL seconds. An approximate index is persisted at index_path so
+    it is not rebuilt on every start.
+    """
+    COMPACT_SIZE = 50
+    COMPACT_RATIO = 0.1
+    COMPACT_INTERVAL = 300
+
+    def __init__(self, model_path, vectorizer_path, log_path, index_path=None, index_type='exact', index_params=None):
+        self.model_path = model_path
+        self.vectorizer_path = vectorizer_path
+        self.log_path = log_path
+        self.index_path = index_path
+        self.index_type = index_type
+        self.index_params = index_params or {}
+
+        self.__lock = threading.RLock()
+        self.__compacting = False
+        self.__last_compaction = time.monotonic()
+
+        # processed question -> answer, for both segments
+        self.answers = {}
+
+        # compacted segment
+        self.vectorizer = TfidfVectorizer()
+        self.main_index = create_index(self.index_type, **self.index_params)
+
+        # delta segment, everything learned since the last compaction
+        self.hashing_vectorizer = HashingVectorizer(n_features=2 ** 18, alternate_sign=False, norm='l2')
+        self.delta_keys = []
+        # the part of the delta searched with hashing vectors
+        self.__delta_index_keys = []
+        self.__delta_rows = []
+        self.__delta_index = ExactIndex()
+        self.__delta_dirty = False
+
+        self.__load()
+
+    def __len__(self):
+        return len(self.answers)
+
+    def __load(self):
+        if os.path.exists(self.model_path) and os.path.exists(self.vectorizer_path):
+            with open(self.model_path, 'rb') as f:
+                self.answers.update(pickle.load(f))
+            with open(self.vectorizer_path, 'rb') as f:
+                self.vectorizer = pickle.load(f)
+        else:
+            self.__save(self.answers, self.vectorizer)
+
+        known_queries = list(self.answers.keys())
+        self.main_index = self.__load_index(known_queries)
+
+        # replay pairs learned after the last compaction
+        if os.path.exists(self.log_path):
+            with open(self.log_path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        logging.warning(f"Skipping corrupt line in {self.log_path}")
+                        continue
+                    if entry['query'] not in self.answers:
+                        self.__add_to_delta(entry['query'], entry['response'])
+
+    def __persists_index(self):
+        return self.index_path is not None and hasattr(self.main_index, 'save')
+
+    def __load_index(self, known_queries):
+        if self.__persists_index() and os.path.exists(self.index_path):
+            try:
+                index = type(self.main_index).load(self.index_path)
+                # only reuse it if it was built from exactly the questions in the compacted model
+                if index.keys == known_queries:
+                    return index
+            except Exception as e:
+                logging.warning(f"Could not load similarity index from {self.index_path}: {e}")
+
+        index = create_index(self.index_type, **self.index_params)
+        index.build(known_queries, self.vectorizer.transform(known_queries) if known_queries else None)
+        if self.__persists_index():
+            index.save(self.index_path)
+        return index
+
+    def __save(self, answers, vectorizer):
+        # write to a temporary file first so a crash never leaves a half written pickle behind
+        for path, obj in ((self.model_path, answers), (self.vectorizer_path, vectorizer)):
+            tmp_path = f"{path}.tmp"
+            with open(tmp_path, 'wb') as f:
+                pickle.dump(obj, f)
+            os.replace(tmp_path, path)
+
+    def __add_to_delta(self, processed_query, response):
+        self.answers[processed_query] = response
+        self.delta_keys.append(processed_query)
+        self.__index_delta(processed_query)
+
+    def __index_delta(self, processed_query):
+        vocabulary = getattr(self.vectorizer, 'vocabulary_', None)
+        if vocabulary is not None and hasattr(self.main_index, 'add'):
+            self.main_index.add([processed_query], self.vectorizer.transform([processed_query]))
+            # words outside the vocabulary are dropped by the TF-IDF vectorizer until the next refit
+            analyzer = self.vectorizer.build_analyzer()
+            if all(word in vocabulary for word in analyzer(processed_query)):
+                return
+        self.__delta_index_keys.append(processed_query)
+        self.__delta_rows.append(self.hashing_vectorizer.transform([processed_query]))
+        self.__delta_dirty = True
+
+    def add(self, processed_query, response):
+        with self.__lock:
+            if processed_query in self.answers:
+                return False
+
+            with open(self.log_path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps({"query": processed_query, "response": response}) + "\n")
+            self.__add_to_delta(processed_query, response)
+
+        self.maybe_compact()
+        return True
+
+    def search(self, processed_query, k=1):
+        with self.__lock:
+            main_index = self.main_index
+            vectorizer = self.vectorizer
+            if self.__delta_dirty:
+                self.__delta_index = ExactIndex()
+                if self.__delta_rows:
+                    self.__delta_index.build(self.__delta_index_keys, vstack(self.__delta_rows))
+                self.__delta_dirty = False
+            delta_index = self.__delta_index
+
+        matches = []
+        if len(main_index):
+            matches.extend(main_index.search(vectorizer.transform([processed_query]), k))
+        if len(delta_index):
+            matches.extend(delta_index.search(self.hashing_vectorizer.transform([processed_query]), k))
+
+        # a question can sit in both segments while a compaction is being swapped in
+        best = {}
+        for key, score in matches:
+            if score > best.get(key, -1.0):
+                best[key] = score
+        self.maybe_compact()
+        return sorted(best.items(), key=lambda x: x[1], reverse=True)[:k]
+
+    def maybe_compact(self):
+        with self.__lock:
+            if self.__compacting or not self.delta_keys:
+                return
+            # a refit is O(model size), so a large model waits for a delta proportional to it
+            compact_size = max(self.COMPACT_SIZE, int(len(self.answers) * self.COMPACT_RATIO))
+            due = len(self.delta_keys) >= compact_size
+            if not due and compact_size == self.COMPACT_SIZE:
+                due = time.monotonic() - self.__last_compaction >= self.COMPACT_INTERVAL
+            if not due:
+                return
+            self.__compacting = True
+
+        threading.Thread(target=self.__compact, name='learning-store-compaction', daemon=True).start()
+
+    def __compact(self):
+        try:
+            with self.__lock:
+                answers = dict(self.answers)
+                compacted_count = len(self.delta_keys)
+
+            logging.info('Compacting learned ML Model...')
+            known_queries = list(answers.keys())
+            vectorizer = TfidfVectorizer()
+            main_index = create_index(self.index_type, **self.index_params)
+            main_index.build(known_queries, vectorizer.fit_transform(known_queries))
+            self.__save(answers, vectorizer)
+            if self.__persists_index():
+                main_index.save(self.index_path)
+
+            with self.__lock:
+                self.vectorizer = vectorizer
+                self.main_index = main_index
+                # keep whatever was learned while the compaction was running, indexed with the new vectorizer
+                self.delta_keys = self.delta_keys[compacted_count:]
+                self.__delta_index_keys = []
+                self.__delta_rows = []
+                self.__delta_dirty = True
+                for processed_query in self.delta_keys:
+                    self.__index_delta(processed_query)
+                self.__rewrite_log()
+            logging.info('Completed compacting learned ML Model')
+
+        except Exception as e:
+            logging.exception(f"Error while compacting learned ML Model: {e}")
+
+        finally:
+            with self.__lock:
+                self.__compacting = False
+                self.__last_compaction = time.monotonic()
+
+    def __rewrite_log(self):
+        tmp_path = f"{self.log_path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            for processed_query in self.delta_keys:
+                f.write(json.dumps({"query": processed_query, "response": self.answers[processed_query]}) + "\n")
+        os.replace(tmp_path, self.log_path)
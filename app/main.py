@@ -1,18 +1,74 @@
-import nltk
+import asyncio
+import logging
+import argparse
 from dotenv import load_dotenv
-import tkinter as tk
-from chatbot_ui import ChatbotUI
-
-# Download NLTK data
-nltk.download('punkt')
-nltk.download('punkt_tab')
-nltk.download('wordnet')
-nltk.download('stopwords')
+from startup import profiler, load_chatbot
+from metrics import metrics
 
 load_dotenv("../app/.env")
 
+
+def run_ui():
+    with profiler.measure('import tkinter'):
+        import tkinter as tk
+    with profiler.measure('import chatbot_ui'):
+        from chatbot_ui import ChatbotUI
+
+    with profiler.measure('create window'):
+        root = tk.Tk()
+        # the chatbot itself is built on a worker thread once the window is up
+        app = ChatbotUI(root)
+    root.after_idle(profiler.mark, 'window shown')
+    root.mainloop()
+
+
+def run_server(args):
+    from server import ChatServer
+
+    chatbot = load_chatbot()
+    if profiler.enabled:
+        print(profiler.report())
+
+    server = ChatServer(
+        chatbot,
+        host=args.host,
+        port=args.port,
+        max_concurrency=args.max_concurrency,
+        max_resident_sessions=args.max_resident_sessions
+    )
+    try:
+        asyncio.run(server.serve_forever())
+    except KeyboardInterrupt:
+        logging.info('Shutting down the chatbot server...')
+    finally:
+        server.close()
+
+
 if __name__ == "__main__":
-    root = tk.Tk()
-    app = ChatbotUI(root)
-    root.mainloop()  
-            
+    parser = argparse.ArgumentParser(description='Banking Assistant Chatbot')
+    parser.add_argument('--server', action='store_true', help='run the headless HTTP/WebSocket server instead of the desktop UI')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--max-concurrency', type=int, default=32, help='maximum number of requests processed at once')
+    parser.add_argument('--max-resident-sessions', type=int, default=10000, help='sessions kept in memory, the least recently used ones are moved to SQLite')
+    parser.add_argument('--profile-startup', action='store_true', help='print how long each import and initialization step took')
+    parser.add_argument('--log-level', default='INFO', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'])
+    parser.add_argument('--metrics', action='store_true', help='collect stage timings and counters, always on with --server')
+    parser.add_argument('--metrics-snapshot', metavar='PATH', help='write the metrics as JSON to this file periodically and on exit')
+    parser.add_argument('--metrics-interval', type=float, default=60, help='seconds between metrics snapshots')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=args.log_level, format='%(asctime)s %(levelname)s [%(threadName)s] %(message)s')
+    profiler.enabled = args.profile_startup
+    metrics.enabled = args.metrics or args.server or bool(args.metrics_snapshot)
+    if args.metrics_snapshot:
+        metrics.start_snapshots(args.metrics_snapshot, args.metrics_interval)
+
+    try:
+        if args.server:
+            run_server(args)
+        else:
+            run_ui()
+    finally:
+        if args.metrics_snapshot:
+            metrics.stop_snapshots(args.metrics_snapshot)
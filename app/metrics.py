@@ -0,0 +1,213 @@
+import os
+import json
+import time
+import logging
+import threading
+from functools import wraps
+
+
+class _Timer:
+    __slots__ = ('metrics', 'name', 'labels', 'start')
+
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        self.metrics.observe(self.name, time.perf_counter() - self.start, **self.labels)
+        if exc_type is not None:
+            self.metrics.inc('chatbot_errors_total', metric=self.name, error=exc_type.__name__, **self.labels)
+        return False
+
+
+class _NoopTimer:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        return False
+
+
+NOOP_TIMER = _NoopTimer()
+
+
+class Histogram:
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                break
+        else:
+            i = len(self.buckets)
+        self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+    # upper bound of the bucket holding the given quantile, an estimate good enough for dashboards
+    def quantile(self, q):
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+
+class Metrics:
+    """Process wide counters and histograms, exported as Prometheus text or JSON snapshots.
+
+    Disabled by default, inc() and observe() then return straight away and timer() hands out a shared
+    no-op context manager, so the instrumentation left in the hot paths costs a method call. Series are
+    identified by a name and keyword labels, e.g. metrics.inc('chatbot_route_total', route='loan').
+    """
+    # seconds, unless other buckets are set for a histogram
+    DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+    def __init__(self):
+        self.enabled = False
+        self.counters = {}
+        self.histograms = {}
+        self.buckets = {}
+        self.__lock = threading.Lock()
+        self.__snapshot_thread = None
+        self.__stop_snapshots = threading.Event()
+
+    def set_buckets(self, name, buckets):
+        self.buckets[name] = tuple(buckets)
+
+    def inc(self, name, amount=1, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self.__lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self.__lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(self.buckets.get(name, self.DEFAULT_BUCKETS))
+            histogram.observe(value)
+
+    # with metrics.timer('chatbot_stage_seconds', stage='typo_fix'): ...
+    def timer(self, name, **labels):
+        if not self.enabled:
+            return NOOP_TIMER
+        return _Timer(self, name, labels)
+
+    # decorator version of timer(), checks whether metrics are enabled on every call
+    def timed(self, name, **labels):
+        def decorator(func):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return func(*args, **kwargs)
+                with _Timer(self, name, labels):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def reset(self):
+        with self.__lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+    @staticmethod
+    def __format_labels(labels, extra=()):
+        labels = tuple(labels) + tuple(extra)
+        if not labels:
+            return ""
+        escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in labels)
+        return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(labels, escaped)) + "}"
+
+    def prometheus(self):
+        with self.__lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((key, (histogram.buckets, list(histogram.counts), histogram.sum, histogram.count)) for key, histogram in self.histograms.items())
+
+        lines = []
+        typed = set()
+        for (name, labels), value in counters:
+            if name not in typed:
+                lines.append(f"# TYPE {name} counter")
+                typed.add(name)
+            lines.append(f"{name}{self.__format_labels(labels)} {value}")
+
+        for (name, labels), (buckets, counts, total, count) in histograms:
+            if name not in typed:
+                lines.append(f"# TYPE {name} histogram")
+                typed.add(name)
+            cumulative = 0
+            for bound, bucket_count in zip(buckets, counts):
+                cumulative += bucket_count
+                lines.append(f"{name}_bucket{self.__format_labels(labels, [('le', repr(float(bound)))])} {cumulative}")
+            lines.append(f"{name}_bucket{self.__format_labels(labels, [('le', '+Inf')])} {count}")
+            lines.append(f"{name}_sum{self.__format_labels(labels)} {total}")
+            lines.append(f"{name}_count{self.__format_labels(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self):
+        with self.__lock:
+            counters = [{"name": name, "labels": dict(labels), "value": value} for (name, labels), value in sorted(self.counters.items())]
+            histograms = [
+                {
+                    "name": name,
+                    "labels": dict(labels),
+                    "count": histogram.count,
+                    "sum": histogram.sum,
+                    "mean": histogram.sum / histogram.count if histogram.count else 0.0,
+                    "p50": histogram.quantile(0.5),
+                    "p95": histogram.quantile(0.95),
+                    "p99": histogram.quantile(0.99)
+                }
+                for (name, labels), histogram in sorted(self.histograms.items(), key=lambda item: item[0])
+            ]
+        return {"timestamp": time.time(), "counters": counters, "histograms": histograms}
+
+    def write_snapshot(self, path):
+        # replaced atomically so a reader never sees half a file
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.snapshot(), f)
+        os.replace(tmp_path, path)
+
+    # writes a JSON snapshot to path every interval seconds on a background thread
+    def start_snapshots(self, path, interval=60):
+        def run():
+            while not self.__stop_snapshots.wait(interval):
+                try:
+                    self.write_snapshot(path)
+                except Exception as e:
+                    logging.error(f"Could not write metrics snapshot to {path}: {e}")
+
+        self.__stop_snapshots.clear()
+        self.__snapshot_thread = threading.Thread(target=run, name='metrics-snapshot', daemon=True)
+        self.__snapshot_thread.start()
+
+    def stop_snapshots(self, path=None):
+        self.__stop_snapshots.set()
+        if path is not None:
+            self.write_snapshot(path)
+
+
+metrics = Metrics()
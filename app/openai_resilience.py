@@ -0,0 +1,319 @@
+import time
+import random
+import asyncio
+import logging
+import threading
+import openai
+from context_selector import count_tokens
+from metrics import metrics
+
+
+class OpenAIUnavailableError(Exception):
+    """Raised instead of calling the API when the request cannot be sent, see the subclasses."""
+
+
+class CircuitOpenError(OpenAIUnavailableError):
+    def __init__(self, retry_after):
+        super().__init__(f"OpenAI circuit is open, retrying in {retry_after:.1f}s")
+        self.retry_after = retry_after
+
+
+class DeadlineExceededError(OpenAIUnavailableError):
+    def __init__(self, message):
+        super().__init__(message)
+        self.message = message
+
+
+class TokenBucket:
+    """Refills per_minute tokens a minute, up to capacity (a minute's worth by default)."""
+    def __init__(self, per_minute, capacity=None):
+        self.rate = per_minute / 60
+        self.capacity = capacity if capacity is not None else per_minute
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.__lock = threading.Lock()
+
+    def __refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    # takes amount tokens and returns 0, or returns the seconds to wait until they are available
+    def try_acquire(self, amount=1):
+        # a request larger than the bucket could never be sent otherwise
+        amount = min(amount, self.capacity)
+        with self.__lock:
+            self.__refill()
+            if self.tokens >= amount:
+                self.tokens -= amount
+                return 0.0
+            return (amount - self.tokens) / self.rate
+
+    # gives tokens back, or takes more with a negative amount once the real cost is known
+    def adjust(self, amount):
+        with self.__lock:
+            self.__refill()
+            self.tokens = min(self.capacity, self.tokens + amount)
+
+
+class RateLimiter:
+    """Client side requests per minute and tokens per minute limits, either one can be 0 for no limit."""
+    def __init__(self, requests_per_minute=0, tokens_per_minute=0):
+        self.requests = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.tokens = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+
+    def try_acquire(self, tokens):
+        if self.requests is not None:
+            wait = self.requests.try_acquire(1)
+            if wait:
+                return wait
+        if self.tokens is not None:
+            wait = self.tokens.try_acquire(tokens)
+            if wait:
+                if self.requests is not None:
+                    self.requests.adjust(1)
+                return wait
+        return 0.0
+
+    # returns a request that was admitted but never sent
+    def release(self, tokens):
+        if self.requests is not None:
+            self.requests.adjust(1)
+        if self.tokens is not None:
+            self.tokens.adjust(tokens)
+
+    # corrects the token bucket once the usage reported by the API is known
+    def settle(self, estimated_tokens, used_tokens):
+        if self.tokens is not None:
+            self.tokens.adjust(estimated_tokens - used_tokens)
+
+
+class CircuitBreaker:
+    """Stops calling a failing service for a while.
+
+    After failure_threshold consecutive failures the circuit opens and every call is rejected for
+    reset_timeout seconds. It is then half open, a single trial call is let through and closes the
+    circuit again if it succeeds, or reopens it if it fails.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened = 0
+        self.__opened_at = 0.0
+        self.__trial_in_flight = False
+        self.__lock = threading.Lock()
+
+    # seconds until a trial call is allowed, 0 unless the circuit is open
+    def retry_after(self):
+        if self.state != self.OPEN:
+            return 0.0
+        return max(0.0, self.__opened_at + self.reset_timeout - time.monotonic())
+
+    @property
+    def is_open(self):
+        return self.state == self.OPEN and self.retry_after() > 0
+
+    def allow(self):
+        with self.__lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN:
+                if self.retry_after() > 0:
+                    return False
+                self.state = self.HALF_OPEN
+                self.__trial_in_flight = False
+            if self.__trial_in_flight:
+                return False
+            self.__trial_in_flight = True
+            return True
+
+    def record_success(self):
+        with self.__lock:
+            if self.state != self.CLOSED:
+                logging.info('OpenAI circuit closed')
+            self.state = self.CLOSED
+            self.failures = 0
+            self.__trial_in_flight = False
+
+    def record_failure(self):
+        with self.__lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or (self.state == self.CLOSED and self.failures >= self.failure_threshold):
+                self.state = self.OPEN
+                self.opened += 1
+                self.__opened_at = time.monotonic()
+                self.__trial_in_flight = False
+                logging.warning(f"OpenAI circuit opened after {self.failures} failures, retrying in {self.reset_timeout}s")
+
+    # a call that ended without telling whether the service works, lets another trial through
+    def cancel(self):
+        with self.__lock:
+            self.__trial_in_flight = False
+
+
+class ResilientOpenAI:
+    """Rate limits, retries and circuit breaks calls to the OpenAI API, for the sync and async clients alike.
+
+    Each call is admitted by a requests and tokens per minute limiter, its token cost estimated from the
+    prompt. Transient errors (rate limits, connection errors and 5xx) are retried with jittered exponential
+    backoff, honouring Retry-After, for as long as the call fits in deadline seconds. They also count
+    towards the circuit breaker, and while it is open calls fail at once with CircuitOpenError. The SDK
+    clients should be created with max_retries=0 so that they do not retry on their own as well.
+    """
+    TRANSIENT_ERRORS = (openai.RateLimitError, openai.APIConnectionError, openai.InternalServerError)
+    # completion tokens assumed when a call does not set max_tokens
+    DEFAULT_COMPLETION_TOKENS = 300
+    # not worth sending a request with less time than this left
+    MIN_ATTEMPT_TIMEOUT = 0.5
+
+    def __init__(self, requests_per_minute=500, tokens_per_minute=200000, deadline=20, max_attempts=4,
+                 base_delay=0.5, max_delay=8, breaker=None):
+        self.limiter = RateLimiter(requests_per_minute, tokens_per_minute)
+        self.breaker = breaker if breaker is not None else CircuitBreaker()
+        self.deadline = deadline
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+        self.__lock = threading.Lock()
+        self.retries = 0
+        self.throttled = 0
+        self.rejected = 0
+        self.deadline_exceeded = 0
+
+    def estimate_tokens(self, kwargs):
+        prompt_tokens = sum(count_tokens(str(message.get("content", ""))) for message in kwargs.get('messages', ()))
+        return prompt_tokens + kwargs.get('max_tokens', self.DEFAULT_COMPLETION_TOKENS)
+
+    # e.g. resilient.call(client.chat.completions.create, model=..., messages=...)
+    def call(self, create, **kwargs):
+        deadline = time.monotonic() + self.deadline
+        tokens = self.estimate_tokens(kwargs)
+        attempt = 0
+        while True:
+            wait = self.__admit(tokens, deadline)
+            if wait:
+                time.sleep(wait)
+                continue
+            try:
+                result = create(timeout=deadline - time.monotonic(), **kwargs)
+            except Exception as e:
+                time.sleep(self.__retry_delay(e, attempt, deadline))
+                attempt += 1
+                continue
+            self.__record_success(result, tokens)
+            return result
+
+    async def acall(self, create, **kwargs):
+        deadline = time.monotonic() + self.deadline
+        tokens = self.estimate_tokens(kwargs)
+        attempt = 0
+        while True:
+            wait = self.__admit(tokens, deadline)
+            if wait:
+                await asyncio.sleep(wait)
+                continue
+            try:
+                result = await create(timeout=deadline - time.monotonic(), **kwargs)
+            except asyncio.CancelledError:
+                self.breaker.cancel()
+                raise
+            except Exception as e:
+                await asyncio.sleep(self.__retry_delay(e, attempt, deadline))
+                attempt += 1
+                continue
+            self.__record_success(result, tokens)
+            return result
+
+    # returns the seconds to wait for the rate limits, 0 once the call may be sent, or raises when it cannot be
+    def __admit(self, tokens, deadline):
+        if self.breaker.is_open:
+            self.__count_rejection('circuit_open')
+            raise CircuitOpenError(self.breaker.retry_after())
+
+        wait = self.limiter.try_acquire(tokens)
+        if wait:
+            if time.monotonic() + wait + self.MIN_ATTEMPT_TIMEOUT > deadline:
+                self.__count_rejection('deadline')
+                raise DeadlineExceededError(f"OpenAI rate limit leaves no time to send the request, {wait:.1f}s to wait")
+            with self.__lock:
+                self.throttled += 1
+            metrics.observe('chatbot_openai_throttle_seconds', wait)
+            return wait
+
+        if not self.breaker.allow():
+            self.limiter.release(tokens)
+            self.__count_rejection('circuit_open')
+            raise CircuitOpenError(self.breaker.retry_after())
+        return 0.0
+
+    # returns the backoff before the next attempt, or raises the error when it should not be retried
+    def __retry_delay(self, error, attempt, deadline):
+        if not isinstance(error, self.TRANSIENT_ERRORS):
+            if isinstance(error, openai.APIStatusError):
+                # the API answered, it is up even if it refused this request
+                self.breaker.record_success()
+            else:
+                self.breaker.cancel()
+            raise error
+
+        self.breaker.record_failure()
+        # retrying an exhausted quota, or once the circuit has opened, only burns the deadline
+        if attempt + 1 >= self.max_attempts or self.breaker.is_open or getattr(error, 'code', None) == 'insufficient_quota':
+            raise error
+
+        cap = min(self.max_delay, self.base_delay * 2 ** attempt)
+        delay = cap / 2 + random.uniform(0, cap / 2)
+        delay = max(delay, self.__retry_after(error))
+        if time.monotonic() + delay + self.MIN_ATTEMPT_TIMEOUT > deadline:
+            raise error
+
+        with self.__lock:
+            self.retries += 1
+        metrics.inc('chatbot_openai_retries_total', error=type(error).__name__)
+        logging.warning(f"OpenAI call failed ({type(error).__name__}), retrying in {delay:.2f}s")
+        return delay
+
+    @staticmethod
+    def __retry_after(error):
+        response = getattr(error, 'response', None)
+        if response is None:
+            return 0.0
+        try:
+            return float(response.headers.get('retry-after', 0))
+        except (TypeError, ValueError):
+            # an HTTP date, the backoff is used instead
+            return 0.0
+
+    def __record_success(self, result, tokens):
+        self.breaker.record_success()
+        # streams report no usage, their estimate stands
+        usage = getattr(result, 'usage', None)
+        if usage is not None and getattr(usage, 'total_tokens', None) is not None:
+            self.limiter.settle(tokens, usage.total_tokens)
+
+    def __count_rejection(self, reason):
+        with self.__lock:
+            if reason == 'deadline':
+                self.deadline_exceeded += 1
+            else:
+                self.rejected += 1
+        metrics.inc('chatbot_openai_rejected_total', reason=reason)
+
+    def stats(self):
+        with self.__lock:
+            return {
+                "circuit": self.breaker.state,
+                "consecutive_failures": self.breaker.failures,
+                "circuit_opened": self.breaker.opened,
+                "retries": self.retries,
+                "throttled": self.throttled,
+                "rejected": self.rejected,
+                "deadline_exceeded": self.deadline_exceeded
+            }
@@ -0,0 +1,134 @@
+import time
+import asyncio
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from metrics import metrics
+
+
+class ResponseCache:
+    """LRU + TTL cache of OpenAI responses, backed by the llm_response_cache table.
+
+    Keys combine the preprocessed query with a fingerprint of the context injected into the prompt, so
+    a change to the bank data produces new keys and the stale entries simply age out. Entries are kept
+    for max_stale seconds past the ttl, to answer from with get(key, allow_stale=True) when OpenAI is down.
+    """
+    def __init__(self, db, max_entries=1024, ttl=24 * 60 * 60, max_stale=7 * 24 * 60 * 60):
+        self.db = db
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_stale = max_stale
+
+        self.__entries = OrderedDict()
+        self.__lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.__entries)
+
+    @staticmethod
+    def fingerprint(*context):
+        return hashlib.sha256(repr(context).encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def make_key(processed_query, context_fingerprint):
+        return hashlib.sha256(f"{context_fingerprint}\0{processed_query}".encode('utf-8')).hexdigest()
+
+    def get(self, key, allow_stale=False):
+        now = time.time()
+        max_age = self.ttl + self.max_stale if allow_stale else self.ttl
+        response = self.__get_from_memory(key, now, max_age)
+        if response is not None:
+            return response
+        return self.__get_from_disk(key, now, max_age)
+
+    # get() for the event loop, only a memory miss goes to SQLite, on a worker thread
+    async def aget(self, key, allow_stale=False):
+        now = time.time()
+        max_age = self.ttl + self.max_stale if allow_stale else self.ttl
+        response = self.__get_from_memory(key, now, max_age)
+        if response is not None:
+            return response
+        return await asyncio.to_thread(self.__get_from_disk, key, now, max_age)
+
+    def __get_from_memory(self, key, now, max_age):
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is not None:
+                response, created_at = entry
+                if now - created_at <= max_age:
+                    self.__entries.move_to_end(key)
+                    self.__count_hit(now - created_at, disk=False)
+                    return response
+                del self.__entries[key]
+        return None
+
+    # entries evicted from memory, or from a previous run, are still in SQLite
+    def __get_from_disk(self, key, now, max_age):
+        try:
+            entry = self.db.get_cached_response(key)
+        except Exception as e:
+            logging.warning(f"Could not read the response cache: {e}")
+            entry = None
+
+        with self.__lock:
+            if entry is not None and now - entry[1] <= max_age:
+                self.__store(key, entry[0], entry[1])
+                self.__count_hit(now - entry[1], disk=True)
+                return entry[0]
+            self.misses += 1
+            metrics.inc('chatbot_response_cache_total', result='miss')
+        return None
+
+    def __count_hit(self, age, disk):
+        if age > self.ttl:
+            self.stale_hits += 1
+            metrics.inc('chatbot_response_cache_total', result='stale_hit')
+            return
+        self.hits += 1
+        if disk:
+            self.disk_hits += 1
+        metrics.inc('chatbot_response_cache_total', result='disk_hit' if disk else 'hit')
+
+    def put(self, key, response):
+        created_at = time.time()
+        with self.__lock:
+            self.__store(key, response, created_at)
+        self.__write_through(key, response, created_at)
+
+    # put() for the event loop, the entry is usable at once and written to SQLite on a worker thread
+    async def aput(self, key, response):
+        created_at = time.time()
+        with self.__lock:
+            self.__store(key, response, created_at)
+        await asyncio.to_thread(self.__write_through, key, response, created_at)
+
+    def __write_through(self, key, response, created_at):
+        try:
+            self.db.put_cached_response(key, response, created_at)
+        except Exception as e:
+            logging.warning(f"Could not write the response cache: {e}")
+
+    def __store(self, key, response, created_at):
+        self.__entries[key] = (response, created_at)
+        self.__entries.move_to_end(key)
+        while len(self.__entries) > self.max_entries:
+            self.__entries.popitem(last=False)
+
+    def purge_expired(self):
+        self.db.delete_cached_responses_before(time.time() - self.ttl - self.max_stale)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.__entries),
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "stale_hits": self.stale_hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0
+        }
@@ -0,0 +1,378 @@
+import json
+import time
+import base64
+import hashlib
+import asyncio
+import logging
+import weakref
+from http import HTTPStatus
+from urllib.parse import urlsplit, parse_qs
+from concurrent.futures import ThreadPoolExecutor
+from session_store import SessionStore
+from metrics import metrics
+
+
+WEBSOCKET_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+# websocket opcodes
+OP_CONTINUATION = 0x0
+OP_TEXT = 0x1
+OP_BINARY = 0x2
+OP_CLOSE = 0x8
+OP_PING = 0x9
+OP_PONG = 0xA
+
+
+class HTTPError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+class ChatServer:
+    """Headless HTTP + WebSocket front end for a shared Chatbot.
+
+    HTTP:
+        GET  /health                                -> {"status", "sessions", "routes", "static_responses", "prompts", "response_cache", "single_flight", "openai", "feedback_writer"}
+        GET  /metrics                               -> counters and histograms in the Prometheus text format
+        POST /sessions                              -> {"session_id"}
+        POST /chat      {"session_id"?, "message"}  -> {"session_id", "response"}
+        POST /feedback  {"session_id", "rating"}    -> {"status"}
+    WebSocket:
+        GET  /ws?session_id=...  then send {"message": ...} or {"type": "feedback", "rating": ...} text frames
+    """
+    ROUTES = ('/health', '/metrics', '/sessions', '/chat', '/feedback')
+
+    def __init__(self, chatbot, host='127.0.0.1', port=8080, max_concurrency=32, session_timeout=1800, max_body_size=64 * 1024,
+                 max_resident_sessions=10000, max_session_memory=256 * 1024 * 1024):
+        self.chatbot = chatbot
+        self.host = host
+        self.port = port
+        self.max_concurrency = max_concurrency
+        self.session_timeout = session_timeout
+        self.max_body_size = max_body_size
+
+        # idle sessions over the limits are spilled to SQLite and loaded back when the customer returns
+        self.sessions = SessionStore(
+            chatbot.knowledgebase.db,
+            chatbot.new_session,
+            max_resident=max_resident_sessions,
+            max_memory=max_session_memory,
+            session_timeout=session_timeout
+        )
+        # a lock only lives while a request of its session holds or waits for it
+        self.__session_locks = weakref.WeakValueDictionary()
+        self.__semaphore = None
+        self.__executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix='chatbot-worker')
+
+    async def serve_forever(self):
+        self.__semaphore = asyncio.Semaphore(self.max_concurrency)
+        server = await asyncio.start_server(self.handle_connection, self.host, self.port, limit=self.max_body_size)
+        expiry_task = asyncio.create_task(self.__expire_sessions())
+        logging.info(f'Chatbot server listening on http://{self.host}:{self.port}')
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            expiry_task.cancel()
+
+    def close(self):
+        self.__executor.shutdown(wait=True, cancel_futures=True)
+        # conversations carry on after a restart
+        self.sessions.close()
+        self.chatbot.knowledgebase.db.connection_close()
+
+    # ---- sessions ----
+
+    # every acquire_session must be paired with a release_session once the request is done,
+    # a spilled session is loaded on the worker pool and spills are written by the store's own thread
+    async def acquire_session(self, session_id=None, create=True):
+        return await self.sessions.aacquire(session_id, create, self.__executor)
+
+    def release_session(self, session):
+        self.sessions.release(session)
+
+    def session_lock(self, session_id):
+        lock = self.__session_locks.get(session_id)
+        if lock is None:
+            lock = asyncio.Lock()
+            self.__session_locks[session_id] = lock
+        return lock
+
+    async def __expire_sessions(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(60)
+            await loop.run_in_executor(self.__executor, self.sessions.expire)
+
+    # ---- chatbot calls, async pipeline on the loop and blocking work on the worker pool ----
+
+    async def __run(self, session, func, *args):
+        # one request at a time per session keeps its history in order, the semaphore bounds the whole process
+        async with self.session_lock(session.session_id):
+            async with self.__semaphore:
+                if asyncio.iscoroutinefunction(func):
+                    return await func(session, *args)
+                loop = asyncio.get_running_loop()
+                return await loop.run_in_executor(self.__executor, func, session, *args)
+
+    async def __generate_response(self, session, message):
+        with self.chatbot.use_session(session):
+            session.last_user_query = message
+            response = await self.chatbot.agenerate_response(message)
+            session.last_chatbot_response = response
+            return response
+
+    def __train_from_feedback(self, session, rating):
+        with self.chatbot.use_session(session):
+            self.chatbot.train_model_from_feedback(session.last_user_query, session.last_chatbot_response, rating)
+
+    async def chat(self, session, message):
+        if not isinstance(message, str) or not message.strip():
+            raise HTTPError(HTTPStatus.BAD_REQUEST, "'message' must be a non-empty string")
+        return await self.__run(session, self.__generate_response, message.strip())
+
+    async def feedback(self, session, rating):
+        if not isinstance(rating, int) or not 1 <= rating <= 5:
+            raise HTTPError(HTTPStatus.BAD_REQUEST, "'rating' must be an integer from 1 to 5")
+        if not session.last_user_query or not session.last_chatbot_response:
+            raise HTTPError(HTTPStatus.CONFLICT, "No previous response to provide feedback on.")
+        await self.__run(session, self.__train_from_feedback, rating)
+
+    # ---- HTTP ----
+
+    async def handle_connection(self, reader, writer):
+        try:
+            keep_alive = True
+            while keep_alive:
+                request = await self.__read_request(reader)
+                if request is None:
+                    break
+                method, path, query, headers, body = request
+                keep_alive = headers.get('connection', '').lower() != 'close'
+
+                if path == '/ws' and headers.get('upgrade', '').lower() == 'websocket':
+                    await self.__handle_websocket(reader, writer, query, headers)
+                    break
+
+                start = time.perf_counter()
+                try:
+                    status, payload = await self.__dispatch(method, path, body)
+                except HTTPError as e:
+                    status, payload = e.status, {"error": e.message}
+                except Exception as e:
+                    logging.exception(f"Error while handling {method} {path}: {e}")
+                    status, payload = HTTPStatus.INTERNAL_SERVER_ERROR, {"error": "Internal server error"}
+                # unknown paths share one label so scanners cannot grow the series without bound
+                route = path if path in self.ROUTES else 'other'
+                metrics.observe('chatbot_http_request_seconds', time.perf_counter() - start, path=route, status=int(status))
+                await self.__send_response(writer, status, payload, keep_alive)
+
+        except HTTPError as e:
+            await self.__send_response(writer, e.status, {"error": e.message}, keep_alive=False)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def __read_request(self, reader):
+        try:
+            head = await reader.readuntil(b"\r\n\r\n")
+        except asyncio.IncompleteReadError as e:
+            if e.partial:
+                raise
+            return None
+        except asyncio.LimitOverrunError:
+            raise HTTPError(HTTPStatus.REQUEST_HEADER_FIELDS_TOO_LARGE, "Request headers too large")
+
+        lines = head.decode('latin-1').split("\r\n")
+        try:
+            method, target, _ = lines[0].split(" ", 2)
+        except ValueError:
+            raise HTTPError(HTTPStatus.BAD_REQUEST, "Malformed request line")
+
+        headers = {}
+        for line in lines[1:]:
+            if ":" in line:
+                name, value = line.split(":", 1)
+                headers[name.strip().lower()] = value.strip()
+
+        content_length = headers.get('content-length') or "0"
+        # digits only, int() would also take signs, spaces and underscores
+        if not (content_length.isascii() and content_length.isdigit()):
+            raise HTTPError(HTTPStatus.BAD_REQUEST, "Invalid Content-Length")
+        length = int(content_length)
+        if length > self.max_body_size:
+            raise HTTPError(HTTPStatus.REQUEST_ENTITY_TOO_LARGE, "Request body too large")
+        body = await reader.readexactly(length) if length else b""
+
+        url = urlsplit(target)
+        query = {name: values[-1] for name, values in parse_qs(url.query).items()}
+        return method.upper(), url.path, query, headers, body
+
+    async def __dispatch(self, method, path, body):
+        if path == '/health' and method == 'GET':
+            return HTTPStatus.OK, {
+                "status": "ok",
+                "sessions": self.sessions.stats(),
+                "routes": self.chatbot.intent_router.stats(),
+                "static_responses": self.chatbot.static_index.stats(),
+                "prompts": self.chatbot.context_selector.stats(),
+                "response_cache": self.chatbot.response_cache.stats(),
+                "single_flight": self.chatbot.single_flight.stats(),
+                "openai": self.chatbot.openai.stats(),
+                "feedback_writer": self.chatbot.knowledgebase.db.feedback_writer.stats()
+            }
+
+        if path == '/metrics' and method == 'GET':
+            return HTTPStatus.OK, metrics.prometheus()
+
+        if method != 'POST' or path not in ('/sessions', '/chat', '/feedback'):
+            raise HTTPError(HTTPStatus.NOT_FOUND, f"No route for {method} {path}")
+
+        try:
+            data = json.loads(body) if body else {}
+        except ValueError:
+            raise HTTPError(HTTPStatus.BAD_REQUEST, "Body must be JSON")
+        if not isinstance(data, dict):
+            raise HTTPError(HTTPStatus.BAD_REQUEST, "Body must be a JSON object")
+
+        session_id = data.get('session_id')
+        if session_id is not None and not isinstance(session_id, str):
+            raise HTTPError(HTTPStatus.BAD_REQUEST, "'session_id' must be a string")
+
+        if path == '/sessions':
+            session = await self.acquire_session()
+            self.release_session(session)
+            return HTTPStatus.CREATED, {"session_id": session.session_id}
+
+        session = await self.acquire_session(session_id, create=path == '/chat')
+        if session is None:
+            raise HTTPError(HTTPStatus.NOT_FOUND, "Unknown session")
+        try:
+            if path == '/chat':
+                response = await self.chat(session, data.get('message'))
+                return HTTPStatus.OK, {"session_id": session.session_id, "response": response}
+
+            await self.feedback(session, data.get('rating'))
+            return HTTPStatus.OK, {"status": "ok"}
+        finally:
+            self.release_session(session)
+
+    # a str payload is sent as plain text (the /metrics exposition format), anything else as JSON
+    async def __send_response(self, writer, status, payload, keep_alive=True):
+        if isinstance(payload, str):
+            body, content_type = payload.encode('utf-8'), "text/plain; version=0.0.4; charset=utf-8"
+        else:
+            body, content_type = json.dumps(payload).encode('utf-8'), "application/json"
+        head = (
+            f"HTTP/1.1 {int(status)} {HTTPStatus(status).phrase}\r\n"
+            f"Content-Type: {content_type}\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n"
+        )
+        writer.write(head.encode('latin-1') + body)
+        await writer.drain()
+
+    # ---- WebSocket ----
+
+    async def __handle_websocket(self, reader, writer, query, headers):
+        key = headers.get('sec-websocket-key')
+        if not key:
+            raise HTTPError(HTTPStatus.BAD_REQUEST, "Missing Sec-WebSocket-Key")
+        accept = base64.b64encode(hashlib.sha1((key + WEBSOCKET_GUID).encode('latin-1')).digest()).decode('latin-1')
+        writer.write((
+            "HTTP/1.1 101 Switching Protocols\r\n"
+            "Upgrade: websocket\r\n"
+            "Connection: Upgrade\r\n"
+            f"Sec-WebSocket-Accept: {accept}\r\n\r\n"
+        ).encode('latin-1'))
+        await writer.drain()
+
+        # the session stays in memory for as long as the socket is open
+        session = await self.acquire_session(query.get('session_id'))
+        try:
+            await self.__websocket_session(reader, writer, session)
+        finally:
+            self.release_session(session)
+
+    async def __websocket_session(self, reader, writer, session):
+        await self.__send_frame(writer, OP_TEXT, json.dumps({"session_id": session.session_id}).encode('utf-8'))
+
+        while True:
+            message = await self.__read_message(reader, writer)
+            if message is None:
+                return
+            session.touch()
+            try:
+                try:
+                    data = json.loads(message)
+                except ValueError:
+                    data = {"message": message}
+                if not isinstance(data, dict):
+                    data = {"message": message}
+
+                if data.get('type') == 'feedback':
+                    await self.feedback(session, data.get('rating'))
+                    reply = {"type": "feedback", "status": "ok"}
+                else:
+                    reply = {"type": "response", "response": await self.chat(session, data.get('message'))}
+            except HTTPError as e:
+                reply = {"type": "error", "error": e.message}
+            except Exception as e:
+                logging.exception(f"Error while handling websocket message: {e}")
+                reply = {"type": "error", "error": "Internal server error"}
+            await self.__send_frame(writer, OP_TEXT, json.dumps(reply).encode('utf-8'))
+
+    async def __read_frame(self, reader):
+        first, second = await reader.readexactly(2)
+        fin = bool(first & 0x80)
+        opcode = first & 0x0F
+        length = second & 0x7F
+        if length == 126:
+            length = int.from_bytes(await reader.readexactly(2), 'big')
+        elif length == 127:
+            length = int.from_bytes(await reader.readexactly(8), 'big')
+        if length > self.max_body_size:
+            raise ConnectionError("WebSocket frame too large")
+
+        mask = await reader.readexactly(4) if second & 0x80 else None
+        payload = await reader.readexactly(length)
+        if mask:
+            key = (mask * (length // 4 + 1))[:length]
+            payload = (int.from_bytes(payload, 'big') ^ int.from_bytes(key, 'big')).to_bytes(length, 'big')
+        return fin, opcode, payload
+
+    async def __read_message(self, reader, writer):
+        fragments = []
+        while True:
+            fin, opcode, payload = await self.__read_frame(reader)
+            if opcode == OP_CLOSE:
+                await self.__send_frame(writer, OP_CLOSE, payload[:2])
+                return None
+            if opcode == OP_PING:
+                await self.__send_frame(writer, OP_PONG, payload)
+                continue
+            if opcode == OP_PONG:
+                continue
+            if opcode == OP_BINARY:
+                await self.__send_frame(writer, OP_CLOSE, (1003).to_bytes(2, 'big'))
+                return None
+
+            fragments.append(payload)
+            if sum(len(fragment) for fragment in fragments) > self.max_body_size:
+                raise ConnectionError("WebSocket message too large")
+            if fin:
+                return b"".join(fragments).decode('utf-8', errors='replace')
+
+    async def __send_frame(self, writer, opcode, payload):
+        length = len(payload)
+        if length < 126:
+            head = bytes([0x80 | opcode, length])
+        elif length < 1 << 16:
+            head = bytes([0x80 | opcode, 126]) + length.to_bytes(2, 'big')
+        else:
+            head = bytes([0x80 | opcode, 127]) + length.to_bytes(8, 'big')
+        writer.write(head + payload)
+        await writer.drain()
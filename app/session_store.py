@@ -0,0 +1,219 @@
+import time
+import json
+import asyncio
+import logging
+import threading
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+
+class SessionStore:
+    """Chat sessions keyed by id, the recently used ones in memory and the rest spilled to SQLite.
+
+    Resident sessions are kept in LRU order. When there are more than max_resident of them, or their
+    estimated size passes max_memory bytes, the least recently used ones are written to the chat_sessions
+    table and dropped from memory, and acquire() loads them back transparently. A session is pinned from
+    acquire() to release() and never spilled while in use. Sessions idle for session_timeout are deleted.
+
+    No SQLite work is done while holding the lock. Spilled sessions are written in order by a single writer
+    thread, and one that is asked for before its write has finished is taken back from the writer's queue.
+    Event loop callers use aacquire(), which loads spilled sessions on an executor.
+    """
+    # once over a limit, spill down to this fraction of it so spills are written in batches
+    LOW_WATERMARK = 0.9
+
+    def __init__(self, db, create_session, max_resident=10000, max_memory=256 * 1024 * 1024, session_timeout=1800):
+        self.db = db
+        # session_id -> new empty session
+        self.create_session = create_session
+        self.max_resident = max_resident
+        self.max_memory = max_memory
+        self.session_timeout = session_timeout
+
+        self.__sessions = OrderedDict()
+        self.__sizes = {}
+        self.__in_use = Counter()
+        # session_id -> session dropped from memory whose write has not finished yet
+        self.__spilling = {}
+        self.__lock = threading.Lock()
+        self.__writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='session-spill')
+        self.memory = 0
+        self.spilled = 0
+        self.rehydrated = 0
+        self.expired = 0
+
+    def __len__(self):
+        return len(self.__sessions)
+
+    # returns the session, creating it unless create is False, in which case an unknown id gives None
+    def acquire(self, session_id=None, create=True):
+        session = self.__acquire_in_memory(session_id)
+        if session is not None or not session_id:
+            return self.__acquire_loaded(session_id, session, None, create)
+        return self.__acquire_loaded(session_id, None, self.__load_state(session_id), create)
+
+    # acquire() for the event loop, a spilled session is read from SQLite on the executor
+    async def aacquire(self, session_id=None, create=True, executor=None):
+        session = self.__acquire_in_memory(session_id)
+        if session is not None or not session_id:
+            return self.__acquire_loaded(session_id, session, None, create)
+        state = await asyncio.get_running_loop().run_in_executor(executor, self.__load_state, session_id)
+        return self.__acquire_loaded(session_id, None, state, create)
+
+    # pins and returns the session if it is resident or still waiting to be written, else None
+    def __acquire_in_memory(self, session_id):
+        if not session_id:
+            return None
+        with self.__lock:
+            session = self.__sessions.get(session_id) or self.__take_back(session_id)
+            if session is not None:
+                self.__pin(session)
+            return session
+
+    def __acquire_loaded(self, session_id, session, state, create):
+        if session is not None:
+            return session
+        with self.__lock:
+            # another request may have loaded or created it meanwhile
+            session = self.__sessions.get(session_id) if session_id else None
+            if session is None and session_id:
+                session = self.__take_back(session_id)
+            if session is None and state is not None:
+                session = self.create_session(session_id)
+                session.load_state(json.loads(state))
+                self.__add(session)
+                self.rehydrated += 1
+            if session is None:
+                if not create:
+                    return None
+                session = self.create_session(session_id)
+                self.__add(session)
+            self.__pin(session)
+            return session
+
+    def __pin(self, session):
+        self.__sessions.move_to_end(session.session_id)
+        self.__in_use[session.session_id] += 1
+        session.touch()
+
+    def release(self, session):
+        with self.__lock:
+            self.__in_use[session.session_id] -= 1
+            if self.__in_use[session.session_id] <= 0:
+                del self.__in_use[session.session_id]
+            if session.session_id in self.__sessions:
+                self.__resize(session)
+            self.__spill_over_limit()
+
+    def __add(self, session):
+        self.__sessions[session.session_id] = session
+        self.__sizes[session.session_id] = 0
+        self.__resize(session)
+
+    def __resize(self, session):
+        size = session.size()
+        self.memory += size - self.__sizes[session.session_id]
+        self.__sizes[session.session_id] = size
+
+    def __remove(self, session_id):
+        del self.__sessions[session_id]
+        self.memory -= self.__sizes.pop(session_id)
+
+    def __load_state(self, session_id):
+        try:
+            return self.db.get_session_state(session_id)
+        except Exception as e:
+            logging.error(f"Could not load session {session_id}: {e}")
+            return None
+
+    # a session whose spill is still queued is used as is, its pending write is then out of date but harmless
+    def __take_back(self, session_id):
+        session = self.__spilling.pop(session_id, None)
+        if session is not None:
+            self.__add(session)
+        return session
+
+    # spills least recently used sessions that are not in use until the store is within its limits
+    def __spill_over_limit(self):
+        if len(self.__sessions) <= self.max_resident and self.memory <= self.max_memory:
+            return
+        session_ids = []
+        resident = len(self.__sessions)
+        memory = self.memory
+        for session_id in self.__sessions:
+            if resident <= self.max_resident * self.LOW_WATERMARK and memory <= self.max_memory * self.LOW_WATERMARK:
+                break
+            if session_id in self.__in_use:
+                continue
+            session_ids.append(session_id)
+            resident -= 1
+            memory -= self.__sizes[session_id]
+        if session_ids:
+            self.__spill(session_ids)
+
+    # drops the sessions from memory and queues their write, returns the future of the write
+    def __spill(self, session_ids):
+        sessions = []
+        for session_id in session_ids:
+            sessions.append(self.__sessions[session_id])
+            self.__spilling[session_id] = self.__sessions[session_id]
+            self.__remove(session_id)
+        return self.__writer.submit(self.__write, sessions)
+
+    # runs on the writer thread, in the order the spills happened
+    def __write(self, sessions):
+        if not sessions:
+            return
+        now = time.time()
+        rows = [(session.session_id, json.dumps(session.to_state()), now) for session in sessions]
+        try:
+            self.db.save_sessions(rows)
+            with self.__lock:
+                self.spilled += len(rows)
+        except Exception as e:
+            logging.error(f"Could not spill {len(rows)} sessions, they are lost: {e}")
+        finally:
+            with self.__lock:
+                for session in sessions:
+                    # unless it was taken back, and maybe spilled again, meanwhile
+                    if self.__spilling.get(session.session_id) is session:
+                        del self.__spilling[session.session_id]
+
+    # writes every session that is not in use to SQLite and waits for the writes, e.g. before shutting down
+    def spill_all(self):
+        with self.__lock:
+            write = self.__spill([session_id for session_id in self.__sessions if session_id not in self.__in_use])
+        write.result()
+
+    def close(self):
+        self.spill_all()
+        self.__writer.shutdown(wait=True)
+
+    # deletes the sessions idle for longer than session_timeout, resident or spilled
+    def expire(self):
+        deadline = time.monotonic() - self.session_timeout
+        with self.__lock:
+            expired = [
+                session_id for session_id, session in self.__sessions.items()
+                if session.last_access < deadline and session_id not in self.__in_use
+            ]
+            for session_id in expired:
+                self.__remove(session_id)
+            self.expired += len(expired)
+        try:
+            self.db.delete_sessions(expired)
+            self.db.delete_sessions_before(time.time() - self.session_timeout)
+        except Exception as e:
+            logging.error(f"Could not delete expired sessions: {e}")
+
+    def stats(self):
+        with self.__lock:
+            return {
+                "resident": len(self.__sessions),
+                "in_use": len(self.__in_use),
+                "spilling": len(self.__spilling),
+                "memory_bytes": self.memory,
+                "spilled": self.spilled,
+                "rehydrated": self.rehydrated,
+                "expired": self.expired
+            }
@@ -0,0 +1,182 @@
+import os
+import pickle
+import threading
+import numpy as np
+from scipy.sparse import vstack
+from sklearn.preprocessing import normalize
+
+
+class ExactIndex:
+    """Exact cosine similarity search over an L2-normalised CSR matrix of known questions"""
+    def __init__(self):
+        self.keys = []
+        self.matrix = None
+
+    def __len__(self):
+        return len(self.keys)
+
+    def build(self, keys, matrix):
+        self.keys = list(keys)
+        if not self.keys:
+            self.matrix = None
+            return
+        self.matrix = normalize(matrix.tocsr(), norm='l2', copy=False)
+
+    def search(self, query_vec, k=1):
+        if self.matrix is None or k < 1:
+            return []
+
+        query_vec = normalize(query_vec, norm='l2')
+        # one sparse mat-vec gives the cosine similarity with every known question
+        scores = (self.matrix @ query_vec.T).toarray().ravel()
+
+        k = min(k, scores.shape[0])
+        if k == 1:
+            top = [int(np.argmax(scores))]
+        else:
+            top = np.argpartition(-scores, k - 1)[:k]
+            top = top[np.argsort(-scores[top], kind='stable')]
+        return [(self.keys[i], float(scores[i])) for i in top]
+
+
+class LSHIndex:
+    """Approximate cosine similarity search using random-hyperplane LSH over the TF-IDF vectors.
+
+    Every row is hashed into n_tables buckets of n_bits signs each. A search only scores the rows that
+    share a bucket with the query (plus the buckets one bit away when probe_neighbours is set), capped
+    at max_candidates. More tables or neighbour probing raise recall, more bits lower latency.
+
+    Rows are kept in segments whose sizes halve from the first one on. An added batch is a segment of
+    its own, merged with the one before it once it is as large, so a row is copied O(log n) times and a
+    search scores its candidates against O(log n) segments. Searches take no lock, so adding rows from
+    another thread never blocks them.
+    """
+    def __init__(self, n_tables=8, n_bits=12, probe_neighbours=True, max_candidates=2000, seed=42):
+        self.n_tables = n_tables
+        self.n_bits = n_bits
+        self.probe_neighbours = probe_neighbours
+        self.max_candidates = max_candidates
+        self.seed = seed
+
+        self.keys = []
+        self.planes = None
+        self.buckets = [{} for _ in range(n_tables)]
+        self.__segments = ()  # (first id, CSR matrix), replaced rather than changed so searches can read it
+        self.__lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # saved as a single segment
+        if len(self.__segments) > 1:
+            state['_LSHIndex__segments'] = ((0, vstack([matrix for _, matrix in self.__segments]).tocsr()),)
+        del state['_LSHIndex__lock']
+        return state
+
+    def __setstate__(self, state):
+        # indexes saved before segments kept their rows as a list of chunks
+        chunks = state.pop('_LSHIndex__chunks', None)
+        state.pop('_LSHIndex__matrix', None)
+        if chunks is not None:
+            state['_LSHIndex__segments'] = ((0, vstack(chunks).tocsr()),) if chunks else ()
+        self.__dict__.update(state)
+        self.__lock = threading.Lock()
+
+    def __hash_rows(self, matrix):
+        signs = np.asarray(matrix @ self.planes) > 0
+        signs = signs.reshape(matrix.shape[0], self.n_tables, self.n_bits)
+        return signs.astype(np.int64) @ (1 << np.arange(self.n_bits, dtype=np.int64))
+
+    def build(self, keys, matrix):
+        self.keys = []
+        self.planes = None
+        self.buckets = [{} for _ in range(self.n_tables)]
+        self.__segments = ()
+        if keys:
+            self.add(keys, matrix)
+
+    def __append_segment(self, first_id, matrix):
+        segments = list(self.__segments)
+        segments.append((first_id, matrix))
+        while len(segments) > 1 and segments[-2][1].shape[0] <= segments[-1][1].shape[0]:
+            _, last = segments.pop()
+            first_id, previous = segments.pop()
+            segments.append((first_id, vstack([previous, last]).tocsr()))
+        self.__segments = tuple(segments)
+
+    def add(self, keys, matrix):
+        keys = list(keys)
+        if not keys:
+            return
+        matrix = normalize(matrix.tocsr(), norm='l2', copy=False)
+        with self.__lock:
+            if self.planes is None:
+                rng = np.random.default_rng(self.seed)
+                self.planes = rng.standard_normal((matrix.shape[1], self.n_tables * self.n_bits)).astype(np.float32)
+
+            # the rows are stored before they are bucketed, so a search never finds an id it has no row for
+            first_id = len(self.keys)
+            self.keys.extend(keys)
+            self.__append_segment(first_id, matrix)
+
+            codes = self.__hash_rows(matrix)
+            for offset, row_codes in enumerate(codes.tolist()):
+                for table, code in enumerate(row_codes):
+                    self.buckets[table].setdefault(code, []).append(first_id + offset)
+
+    def __candidates(self, query_codes):
+        candidates = set()
+        for table, code in enumerate(query_codes):
+            buckets = self.buckets[table]
+            candidates.update(buckets.get(code, ()))
+            if self.probe_neighbours:
+                for bit in range(self.n_bits):
+                    candidates.update(buckets.get(code ^ (1 << bit), ()))
+            if len(candidates) >= self.max_candidates:
+                break
+        return candidates
+
+    def search(self, query_vec, k=1):
+        if not self.keys or k < 1:
+            return []
+
+        query_vec = normalize(query_vec, norm='l2')
+        # candidates first, the segments read after them have a row for every one
+        candidates = self.__candidates(self.__hash_rows(query_vec)[0].tolist())
+        if not candidates:
+            return []
+        segments = self.__segments
+
+        # exact re-rank of the candidate rows only, segment by segment
+        ids = np.fromiter(candidates, dtype=np.int64)[:self.max_candidates]
+        ids.sort()
+        scores = np.empty(ids.shape[0])
+        for first_id, matrix in segments:
+            start, end = np.searchsorted(ids, (first_id, first_id + matrix.shape[0]))
+            if start < end:
+                scores[start:end] = (matrix[ids[start:end] - first_id] @ query_vec.T).toarray().ravel()
+
+        k = min(k, scores.shape[0])
+        top = np.argsort(-scores, kind='stable')[:k]
+        return [(self.keys[ids[i]], float(scores[i])) for i in top]
+
+    def save(self, path):
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(self, f)
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def load(path):
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+
+
+def create_index(index_type='exact', **params):
+    if index_type == 'exact':
+        return ExactIndex()
+    if index_type == 'lsh':
+        return LSHIndex(**params)
+    raise ValueError(f"Unknown similarity index type: {index_type}")
@@ -0,0 +1,96 @@
+import asyncio
+import threading
+from metrics import metrics
+
+
+class _Call:
+    __slots__ = ('done', 'result', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+    def wait(self):
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class SingleFlight:
+    """Runs one call per key at a time, callers asking for a key already in flight wait and share its result.
+
+    do() is for threads and ado() for coroutines, the latter shares calls per event loop. An exception is
+    raised in every caller sharing the call. Nothing is kept once a call has finished, caching the result
+    is up to the caller, and a key of None runs the call without sharing it.
+    """
+    def __init__(self):
+        self.__calls = {}
+        self.__tasks = {}
+        self.__lock = threading.Lock()
+        self.calls = 0
+        self.shared = 0
+
+    def do(self, key, func, *args):
+        if key is None:
+            return func(*args)
+
+        with self.__lock:
+            call = self.__calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.__calls[key] = _Call()
+            self.__count(leader)
+        if not leader:
+            return call.wait()
+
+        try:
+            call.result = func(*args)
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self.__lock:
+                del self.__calls[key]
+            call.done.set()
+
+    async def ado(self, key, coroutine_function, *args):
+        if key is None:
+            return await coroutine_function(*args)
+
+        loop = asyncio.get_running_loop()
+        with self.__lock:
+            task = self.__tasks.get((loop, key))
+            leader = task is None
+            if leader:
+                # a task of its own, started in the context of the first caller
+                task = self.__tasks[(loop, key)] = loop.create_task(coroutine_function(*args))
+                task.add_done_callback(lambda task: self.__forget(loop, key, task))
+            self.__count(leader)
+        # shielded so a caller that goes away does not cancel the call for the others
+        return await asyncio.shield(task)
+
+    def __forget(self, loop, key, task):
+        with self.__lock:
+            if self.__tasks.get((loop, key)) is task:
+                del self.__tasks[(loop, key)]
+        # marks the error as seen when every caller was cancelled before it was raised
+        if not task.cancelled():
+            task.exception()
+
+    def __count(self, leader):
+        if leader:
+            self.calls += 1
+        else:
+            self.shared += 1
+        metrics.inc('chatbot_single_flight_total', role='leader' if leader else 'follower')
+
+    def stats(self):
+        with self.__lock:
+            return {
+                "in_flight": len(self.__calls) + len(self.__tasks),
+                "calls": self.calls,
+                "shared": self.shared
+            }
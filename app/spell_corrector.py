@@ -0,0 +1,136 @@
+import re
+import threading
+
+
+class SpellCorrector:
+    """SymSpell style spelling correction using a precomputed delete index.
+
+    Every dictionary word is indexed under all the strings obtained by deleting up to max_edit_distance
+    characters from its prefix, so a lookup only generates the deletes of the misspelled word and
+    verifies the few words that share one. correct() also returns a confidence between 0 and 1 so the
+    caller can decide when a slower corrector is worth asking.
+    """
+    TOKEN_PATTERN = re.compile(r"[A-Za-z]+")
+
+    # confidence of a single token
+    KNOWN_CONFIDENCE = 1.0
+    SHORT_UNKNOWN_CONFIDENCE = 0.8
+    CORRECTION_CONFIDENCE = {1: 0.9, 2: 0.7}
+    # an ambiguous correction is a guess at any distance, kept below the threshold for trusting the local fix
+    AMBIGUOUS_CONFIDENCE = 0.4
+    UNKNOWN_CONFIDENCE = 0.5
+
+    def __init__(self, max_edit_distance=2, prefix_length=7, word_checker=None):
+        self.max_edit_distance = max_edit_distance
+        self.prefix_length = prefix_length
+        # optional callable that accepts valid words missing from the dictionary (e.g. inflected forms)
+        self.word_checker = word_checker
+
+        self.words = {}
+        self.deletes = {}
+        self.__lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.words)
+
+    def __edits(self, word, max_distance):
+        edits = {word}
+        current = {word}
+        for _ in range(max_distance):
+            following = set()
+            for edit in current:
+                if len(edit) > 1:
+                    following.update(edit[:i] + edit[i + 1:] for i in range(len(edit)))
+            edits.update(following)
+            current = following
+        return edits
+
+    def add_words(self, words):
+        with self.__lock:
+            for word in words:
+                word = word.lower()
+                if not word.isalpha():
+                    continue
+                if word in self.words:
+                    self.words[word] += 1
+                    continue
+                self.words[word] = 1
+                for delete in self.__edits(word[:self.prefix_length], self.max_edit_distance):
+                    self.deletes.setdefault(delete, []).append(word)
+
+    def add_text(self, text):
+        self.add_words(self.TOKEN_PATTERN.findall(text))
+
+    def is_known(self, word):
+        return word in self.words or (self.word_checker is not None and self.word_checker(word))
+
+    # optimal string alignment distance, gives up as soon as it is above max_distance
+    def distance(self, source, target, max_distance):
+        if abs(len(source) - len(target)) > max_distance:
+            return None
+        previous_previous = None
+        previous = list(range(len(target) + 1))
+        for i in range(1, len(source) + 1):
+            current = [i] + [0] * len(target)
+            for j in range(1, len(target) + 1):
+                cost = 0 if source[i - 1] == target[j - 1] else 1
+                current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + cost)
+                if i > 1 and j > 1 and source[i - 1] == target[j - 2] and source[i - 2] == target[j - 1]:
+                    current[j] = min(current[j], previous_previous[j - 2] + 1)
+            if min(current) > max_distance:
+                return None
+            previous_previous, previous = previous, current
+        return previous[-1] if previous[-1] <= max_distance else None
+
+    # returns (best word, edit distance, ambiguous) or None if nothing is close enough
+    def lookup(self, word):
+        word = word.lower()
+        if self.is_known(word):
+            return word, 0, False
+
+        # short words have too many neighbours to be corrected reliably at distance 2
+        max_distance = 1 if len(word) <= 4 else self.max_edit_distance
+        candidates = set()
+        for delete in self.__edits(word[:self.prefix_length], max_distance):
+            candidates.update(self.deletes.get(delete, ()))
+
+        matches = []
+        for candidate in candidates:
+            distance = self.distance(word, candidate, max_distance)
+            if distance is not None:
+                matches.append((distance, -self.words[candidate], candidate))
+        if not matches:
+            return None
+
+        matches.sort()
+        best_distance, best_frequency, best = matches[0]
+        # a runner-up at the same distance that is nearly as common makes the correction a guess
+        ambiguous = len(matches) > 1 and matches[1][0] == best_distance and -matches[1][1] * 2 > -best_frequency
+        return best, best_distance, ambiguous
+
+    def correct(self, text):
+        confidence = self.KNOWN_CONFIDENCE
+
+        def replace(match):
+            nonlocal confidence
+            token = match.group(0)
+            result = self.lookup(token)
+
+            if result is None:
+                unknown = self.SHORT_UNKNOWN_CONFIDENCE if len(token) <= 2 else self.UNKNOWN_CONFIDENCE
+                confidence = min(confidence, unknown)
+                return token
+
+            word, distance, ambiguous = result
+            if distance == 0:
+                return token
+
+            if ambiguous:
+                token_confidence = self.AMBIGUOUS_CONFIDENCE
+            else:
+                token_confidence = self.CORRECTION_CONFIDENCE.get(distance, self.UNKNOWN_CONFIDENCE)
+            confidence = min(confidence, token_confidence)
+            return word.capitalize() if token[0].isupper() else word
+
+        corrected = self.TOKEN_PATTERN.sub(replace, text)
+        return corrected, confidence
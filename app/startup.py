@@ -0,0 +1,87 @@
+import time
+import logging
+import threading
+from contextlib import contextmanager
+
+
+# nltk.data resource path -> package name for nltk.download
+NLTK_RESOURCES = {
+    'tokenizers/punkt': 'punkt',
+    'tokenizers/punkt_tab': 'punkt_tab',
+    'corpora/wordnet': 'wordnet',
+    'corpora/stopwords': 'stopwords'
+}
+
+
+class StartupProfiler:
+    """Records how long each import and initialization step of the startup takes.
+
+    Disabled by default, measure() then only runs the step. Steps may be measured from any thread,
+    the report lists them in the order they finished together with the time since the process started.
+    """
+    def __init__(self):
+        self.enabled = False
+        self.started_at = time.perf_counter()
+        self.steps = []
+        self.__lock = threading.Lock()
+
+    @contextmanager
+    def measure(self, name):
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.mark(name, time.perf_counter() - start)
+
+    def mark(self, name, duration=0.0):
+        if not self.enabled:
+            return
+        with self.__lock:
+            self.steps.append((name, threading.current_thread().name, duration, time.perf_counter() - self.started_at))
+
+    def report(self):
+        lines = [f"{'step':<32}{'thread':<20}{'duration':>12}{'since start':>14}"]
+        with self.__lock:
+            for name, thread, duration, elapsed in self.steps:
+                lines.append(f"{name:<32}{thread:<20}{duration * 1000:>10.1f}ms{elapsed * 1000:>12.1f}ms")
+        return "\n".join(lines)
+
+
+profiler = StartupProfiler()
+
+
+def ensure_nltk_data():
+    """Download only the NLTK resources that are not installed yet, no network access when all are present"""
+    import nltk
+
+    for resource, package in NLTK_RESOURCES.items():
+        try:
+            nltk.data.find(resource)
+        except LookupError:
+            logging.info(f'Downloading NLTK data {package}...')
+            if not nltk.download(package, quiet=True):
+                logging.error(f"Could not download NLTK data {package}")
+
+
+def load_chatbot():
+    """Import and build the Chatbot, timing the heavy components separately when profiling"""
+    # the heavy dependencies are imported one by one first so the report can tell them apart
+    with profiler.measure('import nltk'):
+        import nltk  # noqa: F401
+    with profiler.measure('NLTK data check'):
+        ensure_nltk_data()
+    with profiler.measure('import sklearn'):
+        import sklearn.feature_extraction.text  # noqa: F401
+    with profiler.measure('import openai'):
+        import openai  # noqa: F401
+    with profiler.measure('import chatbot'):
+        from chatbot import Chatbot
+
+    with profiler.measure('Chatbot()'):
+        chatbot = Chatbot()
+    with profiler.measure('prewarm NLTK corpora'):
+        chatbot.prewarm()
+    return chatbot
@@ -0,0 +1,110 @@
+import re
+import random
+import threading
+from collections import Counter
+from metrics import metrics
+
+
+class StaticResponseIndex:
+    """Answers greetings, thanks and farewells from the static knowledge base without scanning it.
+
+    Patterns and aliases are normalised once into a hash index. The normalised form is lowercase,
+    alphanumeric, single spaced and has repeated letters squeezed, so "Hii" and "helloo" hit the exact index.
+    Patterns of at least fuzzy_min_length characters also match a query one typo away (insertion,
+    deletion, substitution or swap of adjacent characters) or an unambiguous prefix of them, e.g. "goodby".
+    Short patterns such as "hi" or "bye" only match exactly, a typo there is too likely to be another word.
+    """
+    NON_ALPHANUMERIC = re.compile(r'[^a-z0-9\s]')
+    WHITESPACE = re.compile(r'\s+')
+    REPEATED_CHARACTERS = re.compile(r'(.)\1+')
+
+    def __init__(self, patterns, aliases=None, preprocess=None, fuzzy_min_length=5):
+        # pattern -> list of responses, alias -> pattern
+        self.patterns = patterns
+        self.fuzzy_min_length = fuzzy_min_length
+        self.preprocess = preprocess or (lambda text: text)
+
+        self.exact = {}
+        self.deletes = {}
+        self.prefixes = {}
+        self.lookups = Counter()
+        self.__lock = threading.Lock()
+
+        for pattern in patterns:
+            self.__add(pattern, pattern)
+        for alias, pattern in (aliases or {}).items():
+            self.__add(alias, pattern)
+
+    def normalise(self, text):
+        text = self.NON_ALPHANUMERIC.sub('', text.lower())
+        text = self.WHITESPACE.sub(' ', text).strip()
+        return self.REPEATED_CHARACTERS.sub(r'\1', text)
+
+    @staticmethod
+    def __single_deletes(key):
+        return {key[:i] + key[i + 1:] for i in range(len(key))}
+
+    def __add(self, text, pattern):
+        # the same preprocessing as the queries, so e.g. "thank you" is indexed as "thank"
+        key = self.normalise(self.preprocess(text))
+        if not key:
+            return
+        self.exact[key] = pattern
+        if len(key) < self.fuzzy_min_length:
+            return
+
+        # a delete index, two strings are one typo apart only if they share a delete or one is a delete of the other
+        for delete in self.__single_deletes(key) | {key}:
+            self.deletes.setdefault(delete, set()).add(key)
+        # prefixes of more than half the key, one shared by two patterns is ambiguous and dropped
+        for end in range(max(self.fuzzy_min_length, len(key) // 2 + 1), len(key)):
+            prefix = key[:end]
+            if self.prefixes.get(prefix, pattern) != pattern:
+                self.prefixes[prefix] = None
+            else:
+                self.prefixes[prefix] = pattern
+
+    @staticmethod
+    def __is_one_edit(source, target):
+        if abs(len(source) - len(target)) > 1:
+            return False
+        if len(source) == len(target):
+            differences = [i for i in range(len(source)) if source[i] != target[i]]
+            if len(differences) == 1:
+                return True
+            # adjacent transposition
+            return len(differences) == 2 and differences[1] == differences[0] + 1 \
+                and source[differences[0]] == target[differences[1]] and source[differences[1]] == target[differences[0]]
+        shorter, longer = sorted((source, target), key=len)
+        return any(longer[:i] + longer[i + 1:] == shorter for i in range(len(longer)))
+
+    def __fuzzy(self, key):
+        candidates = set()
+        for delete in self.__single_deletes(key) | {key}:
+            candidates.update(self.deletes.get(delete, ()))
+        patterns = {self.exact[candidate] for candidate in candidates if self.__is_one_edit(key, candidate)}
+        # a query close to two different patterns is not answered from here
+        return patterns.pop() if len(patterns) == 1 else None
+
+    # returns (pattern, 'exact' | 'prefix' | 'fuzzy') or (None, None)
+    def lookup(self, processed_query):
+        key = self.normalise(processed_query)
+        pattern, kind = self.exact.get(key), 'exact'
+        if pattern is None and len(key) >= self.fuzzy_min_length - 1:
+            pattern, kind = self.prefixes.get(key), 'prefix'
+            if pattern is None:
+                pattern, kind = self.__fuzzy(key), 'fuzzy'
+        if pattern is None:
+            kind = None
+        with self.__lock:
+            self.lookups[kind or 'miss'] += 1
+        metrics.inc('chatbot_static_lookup_total', result=kind or 'miss')
+        return pattern, kind
+
+    def get_response(self, processed_query):
+        pattern, _ = self.lookup(processed_query)
+        return random.choice(self.patterns[pattern]) if pattern is not None else None
+
+    def stats(self):
+        with self.__lock:
+            return dict(self.lookups)
@@ -0,0 +1,40 @@
+import re
+from functools import lru_cache
+from nltk.stem import WordNetLemmatizer
+from nltk.tokenize.destructive import NLTKWordTokenizer
+
+
+class TextNormaliser:
+    """Lowercases, strips special characters, tokenizes, removes stop words and lemmatizes a query.
+
+    The output is the same as lower() + re.sub + word_tokenize + WordNetLemmatizer, so keys of the saved
+    model stay valid. Once special characters are removed no sentence boundary or punctuation is left, so
+    word_tokenize reduces to its contraction rules (e.g. "cannot" -> "can not") and a whitespace split,
+    which is what is done here with the same compiled patterns. Lemmas and whole results are cached.
+    """
+    SPECIAL_CHARACTERS = re.compile(r'[^a-zA-Z0-9\s]')
+    CONTRACTIONS = NLTKWordTokenizer.CONTRACTIONS2 + NLTKWordTokenizer.CONTRACTIONS3
+
+    def __init__(self, stop_words, lemmatizer=None, lemma_cache_size=50000, query_cache_size=4096):
+        self.stop_words = frozenset(stop_words)
+        self.lemmatizer = lemmatizer or WordNetLemmatizer()
+        self.lemmatize = lru_cache(maxsize=lemma_cache_size)(self.lemmatizer.lemmatize)
+        self.normalise = lru_cache(maxsize=query_cache_size)(self.__normalise)
+
+    def tokenize(self, text):
+        text = f" {text} "
+        for pattern in self.CONTRACTIONS:
+            text = pattern.sub(r" \1 \2 ", text)
+        return text.split()
+
+    def __normalise(self, text):
+        text = self.SPECIAL_CHARACTERS.sub('', text.lower()) # remove special characters
+        lemmatize = self.lemmatize
+        return ' '.join(lemmatize(token) for token in self.tokenize(text) if token not in self.stop_words) # Stop words remove
+
+    # normalises a batch of texts, e.g. for retraining, repeated texts are only processed once
+    def preprocess_many(self, texts):
+        return [self.normalise(text) for text in texts]
+
+    def cache_info(self):
+        return {"lemmas": self.lemmatize.cache_info()._asdict(), "queries": self.normalise.cache_info()._asdict()}
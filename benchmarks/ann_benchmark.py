@@ -0,0 +1,117 @@
+"""Compares the LSH learned-answer index with the exact scan on a synthetic corpus of banking questions.
+
+Run from the repository root:
+    python benchmarks/ann_benchmark.py --size 100000 --queries 1000
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import numpy as np
+from sklearn.feature_extraction.text import TfidfVectorizer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app'))
+from similarity_index import ExactIndex, LSHIndex  # noqa: E402
+
+
+VOCABULARY = (
+    "account savings checking deposit fixed joint loan personal home auto education mortgage interest rate "
+    "branch colombo kandy galle jaffna kurunegala negombo anuradhapura ratnapura matara batticaloa address "
+    "code open close hour day poya holiday card debit credit transfer balance statement payment withdrawal "
+    "pin reset app website online document id passport license apply minimum maximum amount term year month "
+    "fee charge limit atm cash cheque salary pension foreign currency exchange remittance overdraft lock"
+).split()
+
+
+def make_corpus(size, rng):
+    questions = set()
+    while len(questions) < size:
+        questions.add(' '.join(rng.sample(VOCABULARY, rng.randint(3, 8))))
+    return list(questions)
+
+
+# a learned question with one word dropped or swapped, like a rephrased customer question
+def perturb(question, rng):
+    words = question.split()
+    position = rng.randrange(len(words))
+    if len(words) > 3 and rng.random() < 0.5:
+        del words[position]
+    else:
+        words[position] = rng.choice(VOCABULARY)
+    return ' '.join(words)
+
+
+def time_searches(index, query_vecs):
+    results, latencies = [], []
+    for query_vec in query_vecs:
+        start = time.perf_counter()
+        matches = index.search(query_vec, 1)
+        latencies.append(time.perf_counter() - start)
+        results.append(matches[0][0] if matches else None)
+    return results, np.array(latencies) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--size', type=int, default=100000, help='number of learned questions')
+    parser.add_argument('--queries', type=int, default=1000, help='number of lookups to time')
+    parser.add_argument('--tables', type=int, default=8, help='LSH hash tables')
+    parser.add_argument('--bits', type=int, default=12, help='LSH bits per table')
+    parser.add_argument('--no-probe', action='store_true', help='disable probing neighbouring buckets')
+    parser.add_argument('--max-candidates', type=int, default=2000)
+    parser.add_argument('--seed', type=int, default=7)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    corpus = make_corpus(args.size, rng)
+    vectorizer = TfidfVectorizer()
+    matrix = vectorizer.fit_transform(corpus)
+    query_vecs = [vectorizer.transform([perturb(rng.choice(corpus), rng)]) for _ in range(args.queries)]
+
+    exact = ExactIndex()
+    start = time.perf_counter()
+    exact.build(corpus, matrix)
+    exact_build = time.perf_counter() - start
+
+    lsh = LSHIndex(
+        n_tables=args.tables,
+        n_bits=args.bits,
+        probe_neighbours=not args.no_probe,
+        max_candidates=args.max_candidates
+    )
+    start = time.perf_counter()
+    lsh.build(corpus, matrix)
+    lsh_build = time.perf_counter() - start
+
+    exact_results, exact_latency = time_searches(exact, query_vecs)
+    lsh_results, lsh_latency = time_searches(lsh, query_vecs)
+    recall = sum(a == b for a, b in zip(exact_results, lsh_results)) / len(exact_results)
+
+    report = {
+        "size": args.size,
+        "queries": args.queries,
+        "lsh_params": {
+            "n_tables": args.tables,
+            "n_bits": args.bits,
+            "probe_neighbours": not args.no_probe,
+            "max_candidates": args.max_candidates
+        },
+        "recall_at_1": recall,
+        "exact": {
+            "build_s": exact_build,
+            "p50_ms": float(np.percentile(exact_latency, 50)),
+            "p99_ms": float(np.percentile(exact_latency, 99))
+        },
+        "lsh": {
+            "build_s": lsh_build,
+            "p50_ms": float(np.percentile(lsh_latency, 50)),
+            "p99_ms": float(np.percentile(lsh_latency, 99))
+        }
+    }
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
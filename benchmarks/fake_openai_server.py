@@ -0,0 +1,175 @@
+"""Local stand-in for the OpenAI chat completions endpoint, for benchmarks that must not hit the real API.
+
+Answers POST /v1/chat/completions, plain or streamed as server-sent events, after a configurable
+delay before the first token and at a configurable token rate. Point a client at it with
+OPENAI_BASE_URL=http://127.0.0.1:<port>/v1 and any OPENAI_API_KEY.
+
+Run standalone from the repository root:
+    python benchmarks/fake_openai_server.py --port 8765 --latency 0.3 --tokens-per-second 50
+"""
+import json
+import time
+import uuid
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+DEFAULT_REPLY = (
+    "Thank you for contacting TrustBank. Our branches are open from 8.00 am to 8.00 pm, Monday to Saturday, "
+    "and you can also reach us through the TrustBank Banking App or www.trustbank.lk."
+)
+
+
+class FakeOpenAIServer:
+    """Serves fake chat completions on a background thread.
+
+    latency is the delay in seconds before the first token, tokens_per_second the rate at which the
+    rest of reply is produced (0 for no delay), a token being a word here.
+    """
+    def __init__(self, host='127.0.0.1', port=0, latency=0.3, tokens_per_second=50, reply=DEFAULT_REPLY):
+        self.latency = latency
+        self.tokens_per_second = tokens_per_second
+        self.reply = reply
+        self.requests = 0
+        self.__lock = threading.Lock()
+
+        self.httpd = ThreadingHTTPServer((host, port), self.__make_handler())
+        self.httpd.daemon_threads = True
+        self.__thread = None
+
+    @property
+    def base_url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def start(self):
+        self.__thread = threading.Thread(target=self.httpd.serve_forever, name='fake-openai', daemon=True)
+        self.__thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def tokens(self):
+        words = self.reply.split(' ')
+        return [word if i == 0 else f" {word}" for i, word in enumerate(words)]
+
+    def token_delay(self):
+        return 1 / self.tokens_per_second if self.tokens_per_second else 0
+
+    def count_request(self):
+        with self.__lock:
+            self.requests += 1
+
+    def __make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_POST(self):
+                if not self.path.rstrip('/').endswith('/chat/completions'):
+                    self.send_json(404, {"error": {"message": f"No route for {self.path}", "type": "invalid_request_error"}})
+                    return
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                try:
+                    request = json.loads(body or b'{}')
+                except ValueError:
+                    self.send_json(400, {"error": {"message": "Body must be JSON", "type": "invalid_request_error"}})
+                    return
+
+                server.count_request()
+                time.sleep(server.latency)
+                if request.get('stream'):
+                    self.stream_completion(request)
+                else:
+                    self.send_completion(request)
+
+            def send_json(self, status, payload):
+                data = json.dumps(payload).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def send_completion(self, request):
+                tokens = server.tokens()
+                time.sleep(server.token_delay() * (len(tokens) - 1))
+                prompt_tokens = sum(len(str(message.get('content', '')).split()) for message in request.get('messages', []))
+                self.send_json(200, {
+                    "id": f"chatcmpl-{uuid.uuid4().hex}",
+                    "object": "chat.completion",
+                    "created": int(time.time()),
+                    "model": request.get('model', 'gpt-3.5-turbo'),
+                    "choices": [{
+                        "index": 0,
+                        "message": {"role": "assistant", "content": server.reply},
+                        "finish_reason": "stop"
+                    }],
+                    "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": len(tokens), "total_tokens": prompt_tokens + len(tokens)}
+                })
+
+            def stream_completion(self, request):
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/event-stream')
+                self.send_header('Cache-Control', 'no-cache')
+                self.send_header('Connection', 'close')
+                self.end_headers()
+                self.close_connection = True
+
+                completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+                created = int(time.time())
+
+                def chunk(delta, finish_reason=None):
+                    return {
+                        "id": completion_id,
+                        "object": "chat.completion.chunk",
+                        "created": created,
+                        "model": request.get('model', 'gpt-3.5-turbo'),
+                        "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]
+                    }
+
+                events = [chunk({"role": "assistant", "content": ""})]
+                events += [chunk({"content": token}) for token in server.tokens()]
+                events.append(chunk({}, "stop"))
+                try:
+                    for i, event in enumerate(events):
+                        if 1 < i < len(events) - 1:
+                            time.sleep(server.token_delay())
+                        self.wfile.write(f"data: {json.dumps(event)}\n\n".encode('utf-8'))
+                        self.wfile.flush()
+                    self.wfile.write(b"data: [DONE]\n\n")
+                    self.wfile.flush()
+                except (BrokenPipeError, ConnectionResetError):
+                    # the client closed the stream early
+                    pass
+
+        return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency', type=float, default=0.3, help='seconds before the first token')
+    parser.add_argument('--tokens-per-second', type=float, default=50, help='rate of the remaining tokens, 0 for instant')
+    args = parser.parse_args()
+
+    server = FakeOpenAIServer(args.host, args.port, args.latency, args.tokens_per_second)
+    print(f"Fake OpenAI server listening on {server.base_url}")
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.httpd.server_close()
+
+
+if __name__ == '__main__':
+    main()
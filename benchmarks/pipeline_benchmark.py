@@ -0,0 +1,217 @@
+"""Times every stage of Chatbot.generate_response against a local fake OpenAI server.
+
+The real pipeline runs in a scratch directory, so the database, learned model and response cache start
+empty and the files of the app are left alone. Learned-answer lookups are also timed against synthetic
+models of 1k, 10k and 100k questions. The report is JSON, on stdout or in --output, so runs of two
+releases can be compared.
+
+Run from the repository root:
+    python benchmarks/pipeline_benchmark.py --iterations 50 --latency 0.3 --tokens-per-second 50 --output report.json
+"""
+import os
+import sys
+import json
+import time
+import pickle
+import random
+import argparse
+import datetime
+import platform
+import tempfile
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app'))
+from fake_openai_server import FakeOpenAIServer  # noqa: E402
+from ann_benchmark import make_corpus, perturb  # noqa: E402
+
+
+QUERIES = (
+    "Hii",
+    "thank you",
+    "What is the interest rate of a fixed deposit account?",
+    "Where is the Galle branch?",
+    "How much can I borrow with a home loan?",
+    "What documents do I need to open an account?",
+    "Can I reset the PIN of my debit card online?",
+    "wat are the opning hours on saturdy"
+)
+
+
+def summarise(samples):
+    latencies = np.array(samples) * 1000
+    return {
+        "count": len(samples),
+        "mean_ms": float(latencies.mean()),
+        "p50_ms": float(np.percentile(latencies, 50)),
+        "p95_ms": float(np.percentile(latencies, 95)),
+        "p99_ms": float(np.percentile(latencies, 99)),
+        "max_ms": float(latencies.max())
+    }
+
+
+class StageTimer:
+    def __init__(self):
+        self.samples = {}
+
+    def time(self, stage, func, *args):
+        start = time.perf_counter()
+        result = func(*args)
+        self.samples.setdefault(stage, []).append(time.perf_counter() - start)
+        return result
+
+    def report(self):
+        return {stage: summarise(samples) for stage, samples in self.samples.items()}
+
+
+# what every domain query paid before the reference snapshot
+def fetch_reference_rows(db):
+    return db.get_all_account_types(), db.get_all_loan_types(), db.get_all_branches()
+
+
+def consume_stream(timer, stream):
+    start = time.perf_counter()
+    chunks = []
+    for chunk in stream:
+        if not chunks:
+            timer.samples.setdefault('llm_first_token', []).append(time.perf_counter() - start)
+        chunks.append(chunk)
+    timer.samples.setdefault('llm_stream_total', []).append(time.perf_counter() - start)
+    return "".join(chunks)
+
+
+def run_pipeline(chatbot, iterations):
+    timer = StageTimer()
+    for iteration in range(iterations):
+        for query in QUERIES:
+            fixed_query = timer.time('typo_fix', chatbot.fix_typos_and_grammer, query)
+
+            # cold normalisation, the lemma cache stays warm as it would in a running app
+            chatbot.normaliser.normalise.cache_clear()
+            processed_query = timer.time('preprocess_text', chatbot.preprocess_text, fixed_query)
+            timer.time('preprocess_text_cached', chatbot.preprocess_text, fixed_query)
+
+            timer.time('static_lookup', chatbot.get_static_response, processed_query)
+            timer.time('learned_lookup', chatbot.find_similar_question_from_model, fixed_query)
+            route = timer.time('intent_route', chatbot.get_query_route, fixed_query)
+
+            timer.time('reference_snapshot', chatbot.knowledgebase.get_reference_snapshot)
+            timer.time('db_fetch_uncached', fetch_reference_rows, chatbot.knowledgebase.db)
+            if route:
+                timer.time('context_selection', chatbot.get_domain_details, route, fixed_query)
+
+            plan = timer.time('plan_query', chatbot.plan_query, fixed_query)
+            if plan.message is not None:
+                timer.time('prompt_build', chatbot.build_openai_messages, plan.message, plan.context)
+                # no cache key, so every call reaches the (fake) API
+                timer.time('llm_call', chatbot.get_response_from_openai, plan.message, None, plan.context)
+                consume_stream(timer, chatbot.get_response_from_openai_stream(plan.message, None, plan.context))
+
+            # end to end, the first round misses the response cache and later rounds hit it
+            stage = 'generate_response_cold' if iteration == 0 else 'generate_response_warm'
+            timer.time(stage, chatbot.generate_response, query)
+    return timer.report()
+
+
+def build_learning_store(directory, size, index_type, rng):
+    from sklearn.feature_extraction.text import TfidfVectorizer
+    from learning_store import LearningStore
+
+    corpus = make_corpus(size, rng)
+    paths = {name: os.path.join(directory, f"{name}_{size}") for name in ('model.pkl', 'vectorizer.pkl', 'log.jsonl', 'index.pkl')}
+    with open(paths['model.pkl'], 'wb') as f:
+        pickle.dump({question: f"Learned answer {i}" for i, question in enumerate(corpus)}, f)
+    with open(paths['vectorizer.pkl'], 'wb') as f:
+        pickle.dump(TfidfVectorizer().fit(corpus), f)
+
+    start = time.perf_counter()
+    store = LearningStore(paths['model.pkl'], paths['vectorizer.pkl'], paths['log.jsonl'], index_path=paths['index.pkl'], index_type=index_type)
+    return store, corpus, time.perf_counter() - start
+
+
+# lookups with a learned model of each size, half rephrased learned questions and half the app queries
+def run_learned_lookups(chatbot, directory, sizes, lookups, index_type, seed):
+    rng = random.Random(seed)
+    original_store = chatbot.learning_store
+    report = {}
+    try:
+        for size in sizes:
+            store, corpus, load_s = build_learning_store(directory, size, index_type, rng)
+            chatbot.learning_store = store
+            chatbot.ml_model = store.answers
+
+            queries = [perturb(rng.choice(corpus), rng) if i % 2 == 0 else rng.choice(QUERIES) for i in range(lookups)]
+            timer = StageTimer()
+            for query in queries:
+                timer.time('lookup', chatbot.find_similar_question_from_model, query)
+            report[str(size)] = dict(summarise(timer.samples['lookup']), load_s=load_s)
+    finally:
+        chatbot.learning_store = original_store
+        chatbot.ml_model = original_store.answers
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--iterations', type=int, default=20, help='rounds over the benchmark queries')
+    parser.add_argument('--latency', type=float, default=0.3, help='seconds before the fake API sends the first token')
+    parser.add_argument('--tokens-per-second', type=float, default=50, help='token rate of the fake API, 0 for instant')
+    parser.add_argument('--sizes', default='1000,10000,100000', help='learned model sizes for the lookup benchmark')
+    parser.add_argument('--lookups', type=int, default=500, help='learned lookups timed per model size')
+    parser.add_argument('--index-type', default='exact', help="learned answer index, 'exact' or 'lsh'")
+    parser.add_argument('--seed', type=int, default=7)
+    parser.add_argument('--output', help='write the JSON report here instead of stdout')
+    args = parser.parse_args()
+
+    server = FakeOpenAIServer(latency=args.latency, tokens_per_second=args.tokens_per_second).start()
+    os.environ['OPENAI_BASE_URL'] = server.base_url
+    os.environ['OPENAI_API_KEY'] = 'benchmark'
+    os.environ['LEARNED_INDEX_TYPE'] = args.index_type
+
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory(prefix='chatbot-benchmark-') as directory:
+        os.chdir(directory)
+        try:
+            from startup import ensure_nltk_data
+            ensure_nltk_data()
+
+            from chatbot import Chatbot
+            start = time.perf_counter()
+            chatbot = Chatbot()
+            chatbot.prewarm()
+            startup_s = time.perf_counter() - start
+
+            stages = run_pipeline(chatbot, args.iterations)
+            sizes = [int(size) for size in args.sizes.split(',') if size]
+            learned_lookups = run_learned_lookups(chatbot, directory, sizes, args.lookups, args.index_type, args.seed)
+            chatbot.knowledgebase.db.connection_close()
+        finally:
+            os.chdir(cwd)
+            server.stop()
+
+    report = {
+        "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "params": {
+            "iterations": args.iterations,
+            "queries": len(QUERIES),
+            "latency_s": args.latency,
+            "tokens_per_second": args.tokens_per_second,
+            "index_type": args.index_type
+        },
+        "startup_s": startup_s,
+        "fake_openai_requests": server.requests,
+        "stages": stages,
+        "learned_lookup": learned_lookups
+    }
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()